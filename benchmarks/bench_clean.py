@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+throughput benchmark of the output of clean, the records are written to
+a temporary file so the cost of the terminal is left out
+
+usage: python benchmarks/bench_clean.py input.fastq
+"""
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bench_fastq import legacy_readfq
+from ontbc.fastq import open_fastq, scan_fastq
+from ontbc.clean import _clean_records
+from ontbc.writer import open_writer
+
+
+LOG = logging.getLogger(__name__)
+
+
+def legacy_clean(file, out):
+    """
+    the line by line readfq and the print of each record replaced by the
+    buffered writer, kept as the baseline
+    """
+    stdout = sys.stdout
+    sys.stdout = open(out, "w")
+
+    for name, seq, qvalue in legacy_readfq(file):
+        if qvalue:
+            print("@%s\n%s\n+\n%s" % (name, seq, qvalue))
+
+    sys.stdout.close()
+    sys.stdout = stdout
+
+
+def buffered_clean(file, out, compress=False):
+    """
+    the records written with FastqWriter
+    """
+    writer = open_writer(out, compress=compress)
+    fp = open_fastq(file)
+
+    _clean_records(scan_fastq(fp), None, writer)
+
+    fp.close()
+    writer.close()
+
+
+def bench(name, func, file, out):
+    """
+    run func over file and report the throughput
+    :param name: name of the writer
+    :param func: function of (file, out)
+    :param file: fastq file
+    :param out: output file
+    """
+    size = os.path.getsize(file)
+    start = time.time()
+
+    func(file, out)
+
+    used = time.time() - start
+    print("%-16s %8.2f s %8.1f MB/s %12s bytes out" % (name, used, size / used / 1e6, os.path.getsize(out)))
+
+
+def main():
+    logging.basicConfig(stream=sys.stderr, level=logging.ERROR)
+
+    if len(sys.argv) != 2:
+        print(__doc__)
+        sys.exit(1)
+
+    file = sys.argv[1]
+    temp = tempfile.mkdtemp(prefix="bench_clean.")
+    out = os.path.join(temp, "out.fastq")
+
+    try:
+        bench("legacy print", legacy_clean, file, out)
+        bench("buffered", buffered_clean, file, out)
+        bench("buffered bgzf", lambda i, o: buffered_clean(i, o, compress=True), file, out)
+    finally:
+        shutil.rmtree(temp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+throughput benchmark of the fastq parsers
+
+usage: python benchmarks/bench_fastq.py input.fastq
+"""
+import os
+import sys
+import time
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ontbc.common import readfq
+from ontbc.fastq import iter_fastq
+
+
+LOG = logging.getLogger(__name__)
+
+# runs of each parser, the fastest is reported
+REPEAT = 3
+
+
+def legacy_readfq(file):
+    """
+    the line by line readfq replaced by ontbc.fastq, kept as the baseline
+    """
+    fp = open(file)
+
+    last = None
+    while True:
+        if not last:
+            for l in fp:
+                if l[0] in '>@':
+                    last = l[:-1]
+                    break
+        if not last: break
+        name, seqs, last = last[1:], [], None
+        for l in fp:
+            if l[0] in '@+':
+                last = l[:-1]
+                break
+            seqs.append(l[:-1])
+        if not last or last[0] != '+':
+            yield name, ''.join(seqs), None
+            if not last: break
+        else:
+            seq, leng, seqs = ''.join(seqs), 0, []
+            for l in fp:
+                seqs.append(l[:-1])
+                leng += len(l) - 1
+
+                if leng == len(seq):
+                    last = None
+                    yield name, seq, ''.join(seqs);
+                    break
+                else:
+                    last = None
+                    break
+            if last:
+                yield name, seq, None
+                break
+
+
+def bench(name, func, file, repeat=REPEAT):
+    """
+    run func over file and report the throughput of the fastest run
+    :param name: name of the parser
+    :param func: generator function of (name, seq, qual)
+    :param file: fastq file
+    :param repeat: number of runs
+    :return: number of reads
+    """
+    size = os.path.getsize(file)
+    times = []
+
+    for i in range(repeat):
+        start = time.time()
+        n = 0
+
+        for record in func(file):
+            n += 1
+
+        times.append(time.time() - start)
+
+    used = min(times)
+
+    print("%-16s %10s reads %8.2f s %8.1f MB/s" % (name, n, used, size / used / 1e6))
+
+    return n
+
+
+def main():
+    logging.basicConfig(stream=sys.stderr, level=logging.ERROR)
+
+    if len(sys.argv) != 2:
+        print(__doc__)
+        sys.exit(1)
+
+    file = sys.argv[1]
+
+    bench("legacy readfq", legacy_readfq, file)
+    bench("readfq", readfq, file)
+    bench("iter_fastq", iter_fastq, file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+read selection of filter against sorting every read
+
+usage: python benchmarks/bench_select.py [reads]
+"""
+import os
+import sys
+import time
+import random
+import logging
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ontbc.table import ReadTable
+from ontbc.filter import _filter_reads
+
+
+def legacy_filter_reads(table, min_length, max_bases):
+    """
+    the selection of filter before the streaming and cutoff paths,
+    every read is sorted by length
+    """
+    r = bytearray(len(table))
+    lengths = table.lengths
+    sum_bases = 0
+
+    for row in sorted(range(len(table)), key=lengths.__getitem__, reverse=True):
+        v = lengths[row]
+        if v < min_length:
+            break
+
+        sum_bases += v
+        r[row] = 1
+
+        if max_bases and sum_bases > max_bases:
+            break
+
+    return r
+
+
+def bench(name, func, *args):
+
+    start = time.time()
+    r = func(*args)
+    print("%-24s %8.2f s %10s reads kept" % (name, time.time() - start, sum(r)))
+
+    return r
+
+
+def main():
+    logging.basicConfig(stream=sys.stderr, level=logging.ERROR)
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+    random.seed(1)
+
+    table = ReadTable()
+    table.lengths = array("I", (int(random.expovariate(1.0 / 8000)) for i in range(n)))
+    max_bases = sum(table.lengths) // 3
+
+    print("%s reads, %s bases" % (n, sum(table.lengths)))
+
+    a = bench("legacy --min_length", legacy_filter_reads, table, 1000, None)
+    b = bench("filter --min_length", _filter_reads, table, None, None, 1000, None)
+    assert a == b
+
+    a = bench("legacy --max_bases", legacy_filter_reads, table, 0, max_bases)
+    b = bench("filter --max_bases", _filter_reads, table, None, None, 0, max_bases)
+    assert a == b
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+memory per read of the read table against the dict of fastq headers
+
+usage: python benchmarks/bench_table.py [reads]
+"""
+import os
+import sys
+import time
+import uuid
+import random
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ontbc.table import ReadTable
+
+
+def headers(n):
+    """
+    fastq headers like the ones written by the basecaller
+    """
+    random.seed(1)
+
+    for i in range(n):
+        read_id = str(uuid.UUID(int=random.getrandbits(128)))
+        yield read_id, "%s runid=b7b3d3a4e6c1e6f3a2e8b2b1c1d5f8e2a3c4b6d7 read=%s ch=%s " \
+                       "start_time=2018-05-01T08:00:00Z" % (read_id, i, i % 512), random.randint(100, 50000)
+
+
+def build_dict(n):
+    r = {}
+    for read_id, name, length in headers(n):
+        r[name] = length
+    return r
+
+
+def build_table(n):
+    r = ReadTable()
+    offset = 0
+    for read_id, name, length in headers(n):
+        r.add(read_id, length, offset, 2 * length + len(name) + 5)
+        offset += 2 * length + len(name) + 5
+    return r
+
+
+def bench(name, func, n):
+    """
+    build the structure of n reads and report the memory it holds
+    """
+    tracemalloc.start()
+    start = time.time()
+    r = func(n)
+    used = time.time() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print("%-12s %10s reads %8.2f s %8.1f bytes/read" % (name, n, used, 1.0 * size / n))
+
+    return r
+
+
+def main():
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    bench("dict", build_dict, n)
+    bench("ReadTable", build_table, n)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,10 @@ import logging
 
 from ontbc.clean import add_clean_parser, clean
 from ontbc.filter import add_filter_parser, filter_reads
+from ontbc.stats import add_stats_parser, stats
+from ontbc.run import add_run_parser, run
 from ontbc.barcode import add_barcode_parser, barcode
+from ontbc.demux import add_demux_parser, demux
 
 from ontbc import __author__, __version__, __email__
 
@@ -29,10 +32,22 @@ def add_ontbc_parser(parser):
     filter_parser = add_filter_parser(filter_parser)
     filter_parser.set_defaults(func=filter_reads)
 
+    run_parser = subparsers.add_parser('run', help="clean, filter and stat records in one pass")
+    run_parser = add_run_parser(run_parser)
+    run_parser.set_defaults(func=run)
+
+    stats_parser = subparsers.add_parser('stats', help="stat runs")
+    stats_parser = add_stats_parser(stats_parser)
+    stats_parser.set_defaults(func=stats)
+
     barcode_parser = subparsers.add_parser('barcode', help="barcoding")
     barcode_parser = add_barcode_parser(barcode_parser)
     barcode_parser.set_defaults(func=barcode)
 
+    demux_parser = subparsers.add_parser('demux', help="demultiplex records by barcodes")
+    demux_parser = add_demux_parser(demux_parser)
+    demux_parser.set_defaults(func=demux)
+
     return parser
 
 
@@ -2,13 +2,16 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import glob
 import os.path
+import hashlib
 import argparse
 import logging
-from tarfile import TarFile
 
 from thirdparty.dagflow import ParallelTask, Task, DAG, do_dag
-from ontbc.common import mkdir, touch, read_tsv
+from ontbc.common import mkdir, read_tsv
+from ontbc.cell import CellScanner, load_chunks, write_fofn
+from ontbc.fast5 import load_f5i
 from ontbc.parser import add_barcode_parser
 from ontbc.config import PORECHOP_BIN, QUEUE
 from ontbc import __file__, __version__, __email__, __author__
@@ -17,88 +20,131 @@ from ontbc import __file__, __version__, __email__, __author__
 LOG = logging.getLogger(__name__)
 
 
-def read_tar(file):
+def task_key(inputs):
+    """
+    a key of the inputs of a task, so a task named by it is done only for
+    the same inputs in a later run
+    :param inputs: list of str, like a path and its size
+    """
+    return hashlib.md5("\n".join(inputs).encode("utf-8")).hexdigest()[:12]
 
-    a = os.path.dirname(file)
 
-    return [os.path.join(a, i) for i in TarFile(file).getnames()]
+def reset_join(work_dir, result, barcode, tasks, join):
+    """
+    the result of a barcode holds the reads of the bc tasks in
+    joined_<barcode>.txt, whose outputs are removed once joined. if a task
+    joined is not a task of this run, as a file of its chunk changed, or the
+    result is missing, the result is joined again from the start and the bc
+    tasks joined into it are run again
+    :param work_dir: work directory of the tasks
+    :param result: fastq of the barcode
+    :param barcode: barcode
+    :param tasks: bc tasks of this run
+    :param join: join task of the barcode
+    :return: True if the result is reset
+    """
+    joined = os.path.join(work_dir, "joined_%s.txt" % barcode)
 
+    if not os.path.exists(joined):
+        return False
 
-def scan_cell(cell):
+    with open(joined) as fh:
+        done = set(i.strip() for i in fh if i.strip())
 
-    fastqs = []
-    summarys = []
-    fast5s = []
+    tasks = dict((i.id, i) for i in tasks)
 
-    for root, dirs, files in os.walk(cell, followlinks=True, topdown=False):
+    if os.path.exists(result) and all(i in tasks for i in done):
+        return False
 
-        for name in files:
-            path = os.path.join(root, name)
-            if name.endswith(".fastq"):
-                fastqs.append(path)
-            elif name.endswith(".txt"):
-                summarys.append(path)
-            elif name.endswith(".fast5"):
-                fast5s.append(path)
-            elif name.endswith(".tar"):
-                fast5s += read_tar(path)
-            else:
-                pass
+    LOG.warning("reads joined into %r changed, join them again" % result)
 
-    return fastqs, summarys, fast5s
+    for i in [tasks[i].done for i in done if i in tasks] + [join.done, result, "%s.gzi" % result, joined] + \
+            glob.glob(os.path.join(work_dir, "bc_*", "%s.joining" % barcode)):
+        if os.path.exists(i):
+            os.remove(i)
 
+    return True
 
-def create_porechop_tasks(cell, barcodes, job_type, work_dir, out_dir):
+
+def create_porechop_tasks(cell, barcodes, job_type, work_dir, out_dir, compress=False, chunk_size=0,
+                          scratch=None, engine="porechop"):
 
     LOG.info("find fastq, summary and fast5 files in %r" % cell)
 
     fastq_fofn = os.path.join(work_dir, "fastq.fofn")
     summary_fofn = os.path.join(work_dir, "summary.fofn")
     fast5_fofn = os.path.join(work_dir, "fast5.fofn")
-    find_done = os.path.join(work_dir, "find_done")
 
-    if not os.path.exists(find_done):
-        fastqs, summarys, fast5s = scan_cell(cell)
+    # only the directories and archives changed since the last run are read
+    scanner = CellScanner(cell, os.path.join(work_dir, "cell.manifest"))
+    fastqs, summarys, fast5s = scanner.scan()
 
-        for i, j in zip([fastq_fofn, summary_fofn, fast5_fofn], [fastqs, summarys, fast5s]):
-            with open(i, "w") as fh:
-                fh.write("%s\n" % "\n".join(j))
+    for i, j in zip([fastq_fofn, summary_fofn, fast5_fofn], [fastqs, summarys, fast5s]):
+        write_fofn(i, j)
 
-        del fastqs, summarys, fast5s
-        touch(find_done)
+    del fastqs, summarys, fast5s
 
     fastqs = [i[0] for i in read_tsv(fastq_fofn)]
     summarys = [i[0] for i in read_tsv(summary_fofn)]
     fast5s = [i[0] for i in read_tsv(fast5_fofn)]
     LOG.info("%s fastq, %s summary and %s fast5 files found" % (len(fastqs), len(summarys), len(fast5s)))
 
-    del summarys, fast5s
+    del fast5s
+
+    # index the fast5 list once for the cell, the join tasks only open it
+    load_f5i(fast5_fofn)
+
+    # the fastq files are grouped into tasks of about chunk_size bytes, the
+    # files of the tasks of the last run stay in them
+    sizes = scanner.file_sizes()
+    chunks = load_chunks(os.path.join(work_dir, "chunks.json"), fastqs, sizes, chunk_size)
+    LOG.info("%s fastq grouped into %s tasks" % (len(fastqs), len(chunks)))
+
+    if scratch:  # the cleaned reads are kept on the disk of the node, not the work directory
+        clean = "clean=$(mktemp -d %s/ontbc_bc.XXXXXX)\ntrap 'rm -rf $clean' EXIT" % scratch
+    else:
+        clean = "clean=."
 
     if job_type == "local":
         _option = ""
     else:
         _option = "-q %s" % ",".join(QUEUE)
 
-    tasks = ParallelTask(
-        id="bc",
-        work_dir="%s/{id}" % work_dir,
-        type=job_type,
-        option=_option,
-        script="""
-{ontbc}/ontbc.py clean {{fastq}} > clean.fastq
-{porechop}/porechop-runner.py -i clean.fastq -b . -t 1 --verbosity 2 --no_split > porechop.log
-rm -rf clean.fastq
-""".format(
-            porechop=PORECHOP_BIN,
-            ontbc=os.path.join(os.path.dirname(__file__), "..")
-        ),
-        fastq=fastqs,
+    if engine == "native":
+        # reads without qualities are dropped by demux like clean, no file is written between
+        script = """
+{ontbc}/ontbc.py demux {{fastq}} --out_dir . 2> demux.log
+"""
+    else:
+        script = """
+{clean}
+{ontbc}/ontbc.py clean {{fastq}} > $clean/clean.fastq
+{porechop}/porechop-runner.py -i $clean/clean.fastq -b . -t 1 --verbosity 2 --no_split > porechop.log
+rm -rf $clean/clean.fastq
+"""
+
+    script = script.format(
+        clean=clean,
+        porechop=PORECHOP_BIN,
+        ontbc=os.path.join(os.path.dirname(__file__), "..")
     )
+    tasks = []
+
+    # the ids are not positions, a file found by a later run leaves the done tasks alone
+    for i in chunks:
+        _id = "bc_%s" % task_key(["%s\t%s" % (j, sizes.get(j)) for j in i])
+        tasks.append(Task(
+            id=_id,
+            work_dir=os.path.join(work_dir, _id),
+            type=job_type,
+            option=_option,
+            script=script.format(fastq=" ".join(i))
+        ))
 
     summary = os.path.join(work_dir, "all.summary.txt")
 
     join_summary = Task(
-        id="join_summary",
+        id="join_summary_%s" % task_key(["%s\t%s" % (i, os.path.getsize(i)) for i in summarys]),
         work_dir=work_dir,
         type=job_type,
         script="""
@@ -108,34 +154,77 @@ less {summary} | xargs cat - > all.summary.txt
         ),
     )
 
+    ontbc = os.path.join(os.path.dirname(__file__), "..")
+    result = "{out}/{{barcode}}/{{barcode}}.fastq".format(out=out_dir)
+
+    if compress:  # bgzf with a .gzi, so the records can still be read by offset
+        # bgzf files appended to each other are still bgzf, the .gzi is made again by filter
+        append = """{ontbc}/ontbc.py clean $i/{{barcode}}.fastq --compress --out $i/{{barcode}}.fastq
+    cat $i/{{barcode}}.fastq.gz >> $result
+    rm -f $i/{{barcode}}.fastq.gz $i/{{barcode}}.fastq.gz.gzi""".format(ontbc=ontbc)
+        empty = ": | {ontbc}/ontbc.py clean - --compress --out {result}".format(ontbc=ontbc, result=result)
+        suffix = ".gz"
+    else:
+        append = "cat $i/{barcode}.fastq >> $result"
+        empty = "touch $result"
+        suffix = ""
+
+    # the reads of a bc task are appended to the result once and its output
+    # removed, the tasks joined are listed in joined_<barcode>.txt. the size
+    # of the result before an append is kept in <task>/<barcode>.joining, so
+    # a join killed on the way appends the task again from there
     join_tasks = ParallelTask(
-        id="join",
+        id="join_%s" % task_key([i.id for i in tasks + [join_summary]] +
+                                ["%s\t%s" % (fast5_fofn, os.path.getsize(fast5_fofn))]),
         work_dir=work_dir,
         type=job_type,
         script="""
 mkdir -p {out}/{{barcode}}
+result={result}{suffix}
+touch joined_{{barcode}}.txt
 
-if [ ! -e {{barcode}}_cat_done ]; then
-    cat */{{barcode}}.fastq > {out}/{{barcode}}/{{barcode}}.fastq
-    touch {{barcode}}_cat_done
-fi
+for i in {tasks}; do
+    if grep -qx $i joined_{{barcode}}.txt; then rm -f $i/{{barcode}}.fastq; continue; fi
+    if [ ! -e $i/{{barcode}}.fastq ]; then continue; fi
 
-rm -rf */{{barcode}}.fastq
+    if [ -e $i/{{barcode}}.joining ]; then
+        truncate -s $(cat $i/{{barcode}}.joining) $result
+    elif [ -e $result ]; then
+        stat -c %s $result > $i/{{barcode}}.joining
+    else
+        echo 0 > $i/{{barcode}}.joining
+    fi
+
+    {append}
+    echo $i >> joined_{{barcode}}.txt
+    rm $i/{{barcode}}.fastq $i/{{barcode}}.joining
+done
+
+if [ ! -e $result ]; then {empty}; fi
+rm -f $result.gzi
 
 cd {out}/{{barcode}}
-{ontbc}/ontbc.py filter --fastq {{barcode}}.fastq --summary {summary} --fast5 {fast5} \\
+{ontbc}/ontbc.py filter --fastq {{barcode}}.fastq{suffix} --summary {summary} --fast5 {fast5} \\
   --min_score -100 --min_length 0 --out {{barcode}}
 rm {{barcode}}.filtered.fastq
 mv {{barcode}}.filtered.summary.txt {{barcode}}.summary.txt
 """.format(
             summary=summary,
-            ontbc=os.path.join(os.path.dirname(__file__), ".."),
+            ontbc=ontbc,
             fast5=fast5_fofn,
-            out=out_dir
+            out=out_dir,
+            result=result,
+            tasks=" ".join(i.id for i in tasks),
+            append=append,
+            empty=empty,
+            suffix=suffix
         ),
         barcode=barcodes
     )
 
+    for barcode, join in zip(barcodes, join_tasks):
+        reset_join(work_dir, result.format(barcode=barcode) + suffix, barcode, tasks, join)
+
     for i in join_tasks:
         i.set_upstream(*tasks)
         i.set_upstream(join_summary)
@@ -143,7 +232,8 @@ mv {{barcode}}.filtered.summary.txt {{barcode}}.summary.txt
     return tasks, join_tasks, join_summary
 
 
-def run_porechop(cell, barcodes, job_type, threads, work_dir, out_dir):
+def run_porechop(cell, barcodes, job_type, threads, work_dir, out_dir, compress=False, chunk_size=0,
+                 scratch=None, engine="porechop"):
 
     assert os.path.isdir(cell), "%r not exist" % cell
 
@@ -155,7 +245,11 @@ def run_porechop(cell, barcodes, job_type, threads, work_dir, out_dir):
         barcodes=barcodes,
         job_type=job_type,
         work_dir=work_dir,
-        out_dir=out_dir
+        out_dir=out_dir,
+        compress=compress,
+        chunk_size=chunk_size,
+        scratch=scratch,
+        engine=engine
     )
 
     dag = DAG("porechop")
@@ -175,7 +269,11 @@ def barcode(args):
         job_type=args.job_type,
         threads=args.threads,
         work_dir=args.work_dir,
-        out_dir=args.out_dir
+        out_dir=args.out_dir,
+        compress=args.compress,
+        chunk_size=args.chunk_size * 1024 * 1024,
+        scratch=args.scratch,
+        engine=args.engine
     )
 
 
@@ -0,0 +1,551 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+threaded readers and writers of gzip and bgzf files
+"""
+import os
+import sys
+import zlib
+import struct
+import bisect
+import logging
+import threading
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+if sys.version[0] == "3":
+    from queue import Queue, Full
+else:
+    from Queue import Queue, Full
+
+
+LOG = logging.getLogger(__name__)
+
+# compressed bytes read from the file at a time
+CHUNK_SIZE = 1024 * 1024
+# bgzf blocks inflated by one task
+BATCH_BLOCKS = 64
+# decompressed chunks buffered ahead of the parser
+QUEUE_DEPTH = 8
+# bytes of data in a bgzf block written, so the block fits in 64 KiB even stored
+BLOCK_DATA = 0xff00
+# zlib level of bgzf blocks written
+COMPRESS_LEVEL = 6
+# the empty block at the end of a bgzf file
+EOF_BLOCK = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00" \
+            b"\x00\x00\x00\x00\x00\x00\x00\x00"
+
+_EOF = object()
+
+
+def is_bgzf(file):
+    """
+    check whether a gzip file is bgzf, block compressed with a "BC" extra field
+    :param file: filename
+    :return: True or False
+    """
+    with open(file, "rb") as fh:
+        head = fh.read(18)
+
+    if len(head) < 18 or head[:4] != b"\x1f\x8b\x08\x04":
+        return False
+
+    xlen = struct.unpack("<H", head[10:12])[0]
+
+    return xlen >= 6 and head[12:14] == b"BC" and head[14:16] == b"\x02\x00"
+
+
+def iter_bgzf_blocks(fp):
+    """
+    split a bgzf file into compressed blocks without inflating them
+    :param fp: binary file object
+    :return: generator of (cdata, crc, isize) of each block
+    """
+    while True:
+        head = fp.read(12)
+
+        if not head:
+            break
+        if len(head) < 12 or head[:4] != b"\x1f\x8b\x08\x04":
+            raise Exception("bgzf block header error at %s" % (fp.tell() - len(head)))
+
+        xlen = struct.unpack("<H", head[10:12])[0]
+        extra = fp.read(xlen)
+        bsize = None
+        pos = 0
+
+        while pos + 4 <= xlen:
+            slen = struct.unpack("<H", extra[pos+2:pos+4])[0]
+            if extra[pos:pos+2] == b"BC":
+                bsize = struct.unpack("<H", extra[pos+4:pos+6])[0]
+            pos += 4 + slen
+
+        if bsize is None:
+            raise Exception("gzip block without BC field in a bgzf file")
+
+        cdata = fp.read(bsize - xlen - 19)
+        crc, isize = struct.unpack("<II", fp.read(8))
+
+        yield cdata, crc, isize
+
+
+def inflate_block(block):
+    """
+    inflate a bgzf block and check it
+    :param block: (cdata, crc, isize)
+    :return: data
+    """
+    cdata, crc, isize = block
+    data = zlib.decompress(cdata, -15)
+
+    if len(data) != isize or zlib.crc32(data) & 0xffffffff != crc:
+        raise Exception("bgzf block crc check failed")
+
+    return data
+
+
+def inflate_gzip(fp):
+    """
+    decompressed chunks of a gzip file, multi-member files supported
+    :param fp: binary file object
+    """
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    while True:
+        data = fp.read(CHUNK_SIZE)
+        if not data:
+            break
+
+        while data:
+            out = d.decompress(data)
+            if out:
+                yield out
+
+            data = d.unused_data
+            if data:  # the start of next member
+                if not data.lstrip(b"\x00"):  # padding at the end
+                    break
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    out = d.flush()
+    if out:
+        yield out
+
+
+def inflate_bgzf(fp, threads=1):
+    """
+    decompressed chunks of a bgzf file, batches of blocks are inflated by a
+    thread pool in parallel
+    :param fp: binary file object
+    :param threads: threads to inflate the blocks
+    """
+    threads = max(threads, 1)
+    pool = ThreadPool(threads)
+    blocks = iter_bgzf_blocks(fp)
+    pending = []
+
+    try:
+        while True:
+            batch = []
+            for block in blocks:
+                batch.append(block)
+                if len(batch) >= BATCH_BLOCKS:
+                    break
+
+            if batch:
+                pending.append(pool.map_async(inflate_block, batch))
+            if not pending:
+                break
+
+            # keep every thread busy while the parser takes the oldest batch
+            if len(pending) > threads or not batch:
+                yield b"".join(pending.pop(0).get())
+    finally:
+        pool.terminate()
+
+
+class ThreadedReader(object):
+    """
+    read only binary file object, the data is decompressed by a background
+    thread into a bounded queue so inflating overlaps with parsing
+    """
+
+    def __init__(self, file, chunks, depth=QUEUE_DEPTH):
+        """
+        :param file: filename
+        :param chunks: function of the opened file returning a generator of
+            decompressed chunks, like inflate_gzip
+        :param depth: chunks buffered ahead of the reader
+        """
+        self.name = file
+        self._fp = open(file, "rb")
+        self._chunks = chunks
+        self._queue = Queue(depth)
+        self._closed = False
+        self._eof = False
+        self._chunk = b""
+        self._pos = 0
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+
+        while not self._closed:
+            try:
+                self._queue.put(item, timeout=0.1)
+                return 1
+            except Full:
+                pass
+
+        return 0
+
+    def _run(self):
+
+        chunks = self._chunks(self._fp)
+
+        try:
+            for chunk in chunks:
+                if not self._put(chunk):
+                    break
+            else:
+                self._put(_EOF)
+        except Exception as e:
+            self._put(e)
+        finally:
+            chunks.close()
+
+    def _next_chunk(self):
+
+        if self._eof:
+            return False
+
+        item = self._queue.get()
+
+        if item is _EOF:
+            self._eof = True
+            return False
+        if isinstance(item, Exception):
+            raise item
+
+        self._chunk = item
+        self._pos = 0
+
+        return True
+
+    def read(self, size=-1):
+        """
+        read at most size bytes, all bytes left if size < 0
+        """
+        r = []
+
+        while size < 0 or size > 0:
+            if self._pos >= len(self._chunk) and not self._next_chunk():
+                break
+
+            if size < 0 or self._pos + size >= len(self._chunk):
+                data = self._chunk[self._pos:] if self._pos else self._chunk
+            else:
+                data = self._chunk[self._pos:self._pos + size]
+
+            self._pos += len(data)
+            if size > 0:
+                size -= len(data)
+            r.append(data)
+
+        return b"".join(r)
+
+    def close(self):
+
+        self._closed = True
+        self._thread.join()
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_gzip(file, threads=1):
+    """
+    open a gzip file with a background decompressor
+    :param file: filename
+    :param threads: threads to inflate bgzf blocks
+    :return: file object
+    """
+    if is_bgzf(file):
+        LOG.debug("read bgzf %r with %s threads" % (file, threads))
+        return ThreadedReader(file, partial(inflate_bgzf, threads=threads))
+
+    return ThreadedReader(file, inflate_gzip)
+
+
+def deflate_block(data, level=COMPRESS_LEVEL):
+    """
+    compress data into a bgzf block
+    :param data: bytes, at most BLOCK_DATA
+    :param level: zlib level
+    :return: bytes of the block
+    """
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+
+    if len(cdata) > 0x10000 - 26:  # data can not be compressed, store it
+        c = zlib.compressobj(0, zlib.DEFLATED, -15)
+        cdata = c.compress(data) + c.flush()
+
+    return struct.pack("<BBBBIBBHBBHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, 66, 67, 2, len(cdata) + 25) + \
+        cdata + struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+
+
+def _deflate(args):
+    return deflate_block(*args)
+
+
+class BgzfWriter(object):
+    """
+    write only binary file object of bgzf, gzip compatible. batches of blocks
+    are compressed by a thread pool while the next batch is filled. the
+    offsets of the blocks are saved to a .gzi index like bgzip -i, so the
+    file can be read from any offset by BgzfRandomReader.
+    """
+
+    def __init__(self, file, threads=1, level=COMPRESS_LEVEL, fh=None):
+        """
+        :param file: filename, the .gzi is written next to it
+        :param threads: threads to compress
+        :param level: zlib level
+        :param fh: binary file object to write to instead of file, no .gzi is written
+        """
+        self.name = file
+        self.threads = max(threads, 1)
+        self.level = level
+        self._fh = fh if fh is not None else open(file, "wb")
+        self._close = fh is None
+        self._buf = []
+        self._nbytes = 0
+        self._batch = []
+        self._pending = None
+        self._pool = ThreadPool(self.threads) if self.threads > 1 else None
+        self._coffset = 0
+        self._uoffset = 0
+        self.index = []  # (compressed offset, uncompressed offset) of blocks but the first
+
+    def write(self, data):
+
+        self._buf.append(data)
+        self._nbytes += len(data)
+
+        if self._nbytes >= BLOCK_DATA:
+            self._cut_blocks()
+
+    def _cut_blocks(self, final=False):
+
+        data = b"".join(self._buf)
+        pos = 0
+
+        while len(data) - pos >= BLOCK_DATA or (final and pos < len(data)):
+            self._batch.append((data[pos:pos + BLOCK_DATA], self.level))
+            pos += BLOCK_DATA
+
+        self._buf = [data[pos:]] if pos < len(data) else []
+        self._nbytes = len(data) - pos
+
+        if len(self._batch) >= BATCH_BLOCKS or (final and self._batch):
+            self._compress_batch()
+
+    def _compress_batch(self):
+
+        batch, self._batch = self._batch, []
+
+        if self._pool is None:
+            self._write_blocks(batch, [deflate_block(*i) for i in batch])
+            return
+
+        # write the batch compressed before while this batch is compressed
+        if self._pending is not None:
+            self._write_blocks(*self._pending)
+        self._pending = (batch, self._pool.map_async(_deflate, batch))
+
+    def _write_blocks(self, batch, blocks):
+
+        if not isinstance(blocks, list):
+            blocks = blocks.get()
+
+        for (data, level), block in zip(batch, blocks):
+            if self._coffset:
+                self.index.append((self._coffset, self._uoffset))
+            self._fh.write(block)
+            self._coffset += len(block)
+            self._uoffset += len(data)
+
+    def flush(self):
+        """
+        compress and write the data buffered, a block ends here
+        """
+        self._cut_blocks(final=True)
+
+        if self._pending is not None:
+            self._write_blocks(*self._pending)
+            self._pending = None
+
+        self._fh.flush()
+
+    def close(self):
+
+        self.flush()
+        self._fh.write(EOF_BLOCK)
+
+        if self._pool is not None:
+            self._pool.terminate()
+
+        if self._close:
+            self._fh.close()
+            write_gzi(self.name, self.index)
+        else:
+            self._fh.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def gzi_path(file):
+    """
+    path of the block index of a bgzf file
+    """
+    return "%s.gzi" % file
+
+
+def write_gzi(file, index):
+    """
+    write the block index of a bgzf file in the format of bgzip -i
+    :param file: bgzf file
+    :param index: (compressed offset, uncompressed offset) of blocks but the first
+    :return: path of the index, None if it can not be written
+    """
+    gzi = gzi_path(file)
+
+    try:
+        with open(gzi, "wb") as fh:
+            fh.write(struct.pack("<Q", len(index)))
+            for i in index:
+                fh.write(struct.pack("<QQ", *i))
+    except (IOError, OSError):
+        LOG.warning("can not write index %r" % gzi)
+        return None
+
+    return gzi
+
+
+def load_gzi(file):
+    """
+    read the block index of a bgzf file, the blocks are scanned without
+    inflating them if the index is missing or older than the file
+    :param file: bgzf file
+    :return: list of (compressed offset, uncompressed offset) of all blocks
+    """
+    gzi = gzi_path(file)
+
+    if os.path.exists(gzi) and os.path.getmtime(gzi) >= os.path.getmtime(file):
+        with open(gzi, "rb") as fh:
+            n = struct.unpack("<Q", fh.read(8))[0]
+            data = fh.read(16 * n)
+
+        return [(0, 0)] + [struct.unpack_from("<QQ", data, i * 16) for i in range(n)]
+
+    LOG.info("Index bgzf blocks of %r" % file)
+    r = []
+    coffset = 0
+    uoffset = 0
+
+    with open(file, "rb") as fh:
+        for cdata, crc, isize in iter_bgzf_blocks(fh):
+            r.append((coffset, uoffset))
+            coffset = fh.tell()
+            uoffset += isize
+
+    write_gzi(file, r[1:])
+
+    return r
+
+
+class BgzfRandomReader(object):
+    """
+    read only binary file object of bgzf which can seek to any offset of
+    the uncompressed data, only the blocks read are inflated
+    """
+
+    def __init__(self, file):
+
+        self.name = file
+        self._fp = open(file, "rb")
+        index = load_gzi(file)
+        self._coffsets = [i[0] for i in index]
+        self._uoffsets = [i[1] for i in index]
+        self._blocks = iter_bgzf_blocks(self._fp)
+        self._block = b""
+        self._start = 0  # uncompressed offset of the block
+        self._pos = 0
+
+    def _next_block(self):
+
+        self._start += len(self._block)
+        self._pos = 0
+
+        for block in self._blocks:
+            self._block = inflate_block(block)
+            return True
+
+        self._block = b""
+        return False
+
+    def seek(self, offset):
+
+        if not self._start <= offset < self._start + len(self._block):
+            i = max(bisect.bisect_right(self._uoffsets, offset) - 1, 0)
+            self._fp.seek(self._coffsets[i])
+            self._blocks = iter_bgzf_blocks(self._fp)
+            self._block = b""
+            self._start = self._uoffsets[i]
+
+            while offset >= self._start + len(self._block) and self._next_block():
+                pass
+
+        self._pos = offset - self._start
+
+    def tell(self):
+        return self._start + self._pos
+
+    def read(self, size=-1):
+        """
+        read at most size bytes, all bytes left if size < 0
+        """
+        r = []
+
+        while size != 0:
+            if self._pos >= len(self._block) and not self._next_block():
+                break
+
+            data = self._block[self._pos:] if size < 0 else self._block[self._pos:self._pos + size]
+            self._pos += len(data)
+            if size > 0:
+                size -= len(data)
+            r.append(data)
+
+        return b"".join(r)
+
+    def close(self):
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
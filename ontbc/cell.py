@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+incremental scanner of the files of a cell. directories are listed on a
+thread pool and a manifest keeps what was found, so a later scan only
+lists the directories and reads the archives which changed
+"""
+import os
+import json
+import stat
+import time
+import os.path
+import logging
+from tarfile import TarFile
+from multiprocessing.pool import ThreadPool
+
+
+LOG = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 2
+# threads listing directories, the scan waits on the file system, not the cpu
+SCAN_THREADS = 16
+# seconds, a directory changed this recently is listed again by the next
+# scan, files added later in the same tick of mtime would be missed
+MTIME_SLACK = 2
+FASTQ_SUFFIXES = (".fastq", ".fq", ".fastq.gz", ".fq.gz")
+
+
+def tar_members(file):
+    """
+    index the files in a tar, the headers are read and the data skipped
+    :param file: tar file
+    :return: list of [name, offset of the data, size]
+    """
+    fh = TarFile(file)
+
+    try:
+        return [[i.name, i.offset_data, i.size] for i in fh if i.isfile()]
+    finally:
+        fh.close()
+
+
+def fast5_line(path, tar=None, offset=0, size=0):
+    """
+    a line of fast5.fofn, the path of a member of a tar is next to the tar
+    and followed by the tar, the offset and the size of its data
+    """
+    if tar is None:
+        return path
+
+    return "%s\t%s\t%s\t%s" % (path, tar, offset, size)
+
+
+def list_dir(path):
+    """
+    list a directory, links are followed like os.walk(followlinks=True)
+    :param path: directory
+    :return: (paths of subdirectories, (name, size, mtime) of files)
+    """
+    dirs = []
+    files = []
+
+    if hasattr(os, "scandir"):
+        for entry in list(os.scandir(path)):
+            try:
+                if entry.is_dir():
+                    dirs.append(entry.path)
+                elif entry.is_file():
+                    st = entry.stat()
+                    files.append((entry.name, st.st_size, st.st_mtime))
+            except OSError:  # broken links or removed during the scan
+                continue
+
+        return dirs, files
+
+    for name in os.listdir(path):
+        try:
+            st = os.stat(os.path.join(path, name))
+        except OSError:
+            continue
+
+        if stat.S_ISDIR(st.st_mode):
+            dirs.append(os.path.join(path, name))
+        elif stat.S_ISREG(st.st_mode):
+            files.append((name, st.st_size, st.st_mtime))
+
+    return dirs, files
+
+
+def read_manifest(file, cell):
+    """
+    read the manifest of a previous scan of the cell
+    :return: dict, empty if there is none
+    """
+    r = {"dirs": {}, "tars": {}}
+
+    if not file or not os.path.exists(file):
+        return r
+
+    try:
+        with open(file) as fh:
+            manifest = json.load(fh)
+    except ValueError:
+        LOG.warning("manifest %r is broken, scan %r again" % (file, cell))
+        return r
+
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("cell") != cell:
+        return r
+
+    return manifest
+
+
+def write_manifest(file, manifest):
+    """
+    write a manifest, to a temporary name first
+    """
+    temp = "%s.%s.tmp" % (file, os.getpid())
+
+    with open(temp, "w") as fh:
+        json.dump(manifest, fh)
+
+    os.rename(temp, file)
+
+    return file
+
+
+class CellScanner(object):
+    """
+    scan the directories of a cell level by level on a thread pool, the
+    listing of a directory whose mtime is unchanged is taken from the
+    manifest. the tars and fastqs are stat by each scan, as a file growing
+    in place leaves the mtime of its directory alone, and the members of a
+    tar whose size and mtime are unchanged are taken from the manifest.
+    the manifest keeps the offset and size of the data of each member, so
+    a fast5 in a tar is read by seek without reading the tar again
+    """
+
+    def __init__(self, cell, manifest=None, threads=SCAN_THREADS):
+
+        self.cell = os.path.abspath(cell)
+        self.manifest = manifest
+        self.threads = threads
+        self._old = read_manifest(manifest, self.cell)
+        self.dirs = {}
+        self.tars = {}
+        self.stats = {}  # path -> (size, mtime) of the tars and fastqs
+        self.listed = 0
+        self.untarred = 0
+
+    def _visit(self, path):
+        """
+        the listing of a directory, from the manifest if it did not change
+        :return: (path, (st_dev, st_ino), {"mtime", "dirs", "files"}, listed),
+            key and listing are None for a directory removed or not readable
+        """
+        try:
+            st = os.stat(path)
+            key = (st.st_dev, st.st_ino)
+            old = self._old["dirs"].get(path)
+
+            if old and old["mtime"] == st.st_mtime:
+                return path, key, old, False
+
+            dirs, files = list_dir(path)
+        except OSError as e:
+            if path == self.cell:
+                raise
+            LOG.warning("skip directory %r: %s" % (path, e))
+            return path, None, None, False
+
+        # a directory changed too recently is not trusted by the next scan
+        mtime = st.st_mtime if time.time() - st.st_mtime > MTIME_SLACK else None
+
+        return path, key, {"mtime": mtime, "dirs": dirs, "files": files}, True
+
+    def _stat(self, path):
+        """
+        :return: (path, (size, mtime)), None for a file removed
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return path, None
+
+        return path, (st.st_size, st.st_mtime)
+
+    def _untar(self, args):
+        """
+        the members of a tar, from the manifest if it did not change
+        """
+        path, size, mtime = args
+        old = self._old["tars"].get(path)
+
+        if old and old[0] == size and old[1] == mtime:
+            return path, old, False
+
+        # a tar changed too recently is read again by the next scan
+        if time.time() - mtime <= MTIME_SLACK:
+            mtime = None
+
+        return path, [size, mtime, tar_members(path)], True
+
+    def scan(self):
+        """
+        :return: (fastqs, summarys, fast5s), sorted
+        """
+        LOG.info("Scan %r with %s threads" % (self.cell, self.threads))
+        pool = ThreadPool(self.threads)
+        seen = set()
+        pending = [self.cell]
+
+        try:
+            while pending:
+                r = pool.map(self._visit, pending)
+                pending = []
+
+                for path, key, entry, listed in r:
+                    if key is None or key in seen:  # removed, or a link back to a directory scanned
+                        continue
+                    seen.add(key)
+                    self.dirs[path] = entry
+                    self.listed += listed
+                    pending += entry["dirs"]
+
+            paths = []
+            for root, entry in self.dirs.items():
+                for name, size, mtime in entry["files"]:
+                    if name.endswith((".tar",) + FASTQ_SUFFIXES):
+                        paths.append(os.path.join(root, name))
+
+            # the sizes in a listing from the manifest may be stale
+            self.stats = dict(pool.map(self._stat, paths))
+            tars = [(i,) + self.stats[i] for i in paths if i.endswith(".tar") and self.stats[i]]
+
+            for path, entry, untarred in pool.map(self._untar, tars):
+                self.tars[path] = entry
+                self.untarred += untarred
+        finally:
+            pool.close()
+            pool.join()
+
+        LOG.info("%s of %s directories listed, %s of %s archives read" % (
+            self.listed, len(self.dirs), self.untarred, len(self.tars)))
+
+        if self.manifest:
+            write_manifest(self.manifest, {
+                "version": MANIFEST_VERSION,
+                "cell": self.cell,
+                "dirs": self.dirs,
+                "tars": self.tars
+            })
+
+        return self.files()
+
+    def file_sizes(self):
+        """
+        size of the tars and fastqs found, stat by the scan
+        :return: dict of path -> size
+        """
+        return dict((path, st[0]) for path, st in self.stats.items() if st)
+
+    def files(self):
+        """
+        fastq, summary and fast5 files found, members of tars are fast5
+        with their tar, offset and size as in fast5_line
+        """
+        fastqs = []
+        summarys = []
+        fast5s = []
+
+        for root, entry in self.dirs.items():
+            for name, size, mtime in entry["files"]:
+                path = os.path.join(root, name)
+
+                if path in self.stats and not self.stats[path]:  # removed since the listing
+                    continue
+
+                if name.endswith(FASTQ_SUFFIXES):
+                    fastqs.append(path)
+                elif name.endswith(".txt"):
+                    summarys.append(path)
+                elif name.endswith(".fast5"):
+                    fast5s.append(path)
+                elif name.endswith(".tar"):
+                    fast5s += [fast5_line(os.path.join(root, i), path, offset, size)
+                               for i, offset, size in self.tars[path][2]]
+
+        return sorted(fastqs), sorted(summarys), sorted(fast5s)
+
+
+def chunk_files(files, sizes, chunk_size):
+    """
+    group files in their order into chunks of about the same size, the
+    number of chunks is the total size over chunk_size
+    :param files: paths
+    :param sizes: dict of path -> size, files not in it are stat
+    :param chunk_size: bytes of a chunk, 0 for a file in each chunk
+    :return: list of lists of paths
+    """
+    if chunk_size <= 0:
+        return [[i] for i in files]
+
+    sizes = [sizes[i] if i in sizes else os.path.getsize(i) for i in files]
+    total = sum(sizes)
+    n = max(1, (total + chunk_size - 1) // chunk_size)
+    r = []
+    chunk = []
+    bases = 0
+
+    for path, size in zip(files, sizes):
+        chunk.append(path)
+        bases += size
+
+        # cut at the multiples of total / n, so the chunks are balanced
+        if len(r) < n - 1 and bases * n >= total * (len(r) + 1):
+            r.append(chunk)
+            chunk = []
+
+    if chunk:
+        r.append(chunk)
+
+    return r
+
+
+def load_chunks(file, files, sizes, chunk_size):
+    """
+    group files into chunks like chunk_files, the chunks of the last run
+    kept in file are left as they are and only the new files are chunked,
+    so a task of a chunk is still done. files removed since are left out of
+    their chunks, the chunks are all made again if chunk_size changed
+    :param file: the chunks of the last run, updated
+    :param files: paths
+    :param sizes: dict of path -> size, files not in it are stat
+    :param chunk_size: bytes of a chunk, 0 for a file in each chunk
+    :return: list of lists of paths
+    """
+    old = []
+
+    if os.path.exists(file):
+        try:
+            with open(file) as fh:
+                r = json.load(fh)
+        except ValueError:
+            LOG.warning("chunks %r are broken, chunk the files again" % file)
+            r = {}
+
+        if r.get("chunk_size") == chunk_size:
+            old = r["chunks"]
+
+    found = set(files)
+    chunks = [[j for j in i if j in found] for i in old]
+    chunks = [i for i in chunks if i]
+    known = set(j for i in chunks for j in i)
+    news = [i for i in files if i not in known]
+
+    LOG.info("%s files in %s chunks of the last run, %s new files" % (len(known), len(chunks), len(news)))
+    chunks += chunk_files(news, sizes, chunk_size)
+    write_manifest(file, {"chunk_size": chunk_size, "chunks": chunks})
+
+    return chunks
+
+
+def write_fofn(file, paths):
+    """
+    write a list of files, the file is left untouched if the list is the
+    same, so the indexes made from it are still fresh
+    :return: True if the list is written
+    """
+    data = "%s\n" % "\n".join(paths)
+
+    if os.path.exists(file):
+        with open(file) as fh:
+            if fh.read() == data:
+                return False
+
+    with open(file, "w") as fh:
+        fh.write(data)
+
+    return True
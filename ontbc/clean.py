@@ -1,23 +1,85 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
 import sys
 import argparse
 import logging
 
 from ontbc.parser import add_clean_parser
-from ontbc.common import readfq
+from ontbc.fastq import open_fastq, scan_fastq
+from ontbc.qscore import mean_qscore
+from ontbc.parallel import can_split, scan_range, map_ranges
+from ontbc.writer import FastqWriter, open_writer, output_name
 from ontbc import __author__, __email__, __version__
 
 LOG = logging.getLogger(__name__)
 
+# options of clean in a worker process, set by _init_worker
+_WORKER = {}
+
+
+def _clean_records(records, min_score, writer):
+    """
+    write the records with qualities and a score >= min_score, records with
+    a bare "+" line are written as the bytes read, others are formatted
+    :param records: generator of scan_fastq
+    :param min_score: minimum mean score of qualities, None to not filter
+    :param writer: FastqWriter
+    :return: number of records written
+    """
+    n = 0
+
+    for buf, base, start, e1, e2, e3, e4 in records:
+        if e4 == e3 + 1:  # no qualities
+            continue
+
+        if min_score is not None and mean_qscore(buf[e3+1:e4]) < min_score:
+            continue
+
+        writer.write_scanned(buf, start, e1, e2, e3, e4)
+        n += 1
+
+    return n
 
-def clean(args):
 
-    for name, seq, qvalue in readfq(args.fastq):
+def _init_worker(min_score):
+    _WORKER["min_score"] = min_score
+
+
+def _clean_range(job):
+    """
+    clean the records of a byte range, run in a worker process
+    :param job: (file, start, end)
+    :return: bytes of the records cleaned
+    """
+    file, start, end = job
+    fh = io.BytesIO()
+    writer = FastqWriter(fh, close=False)
+
+    _clean_records(scan_range(file, start, end), _WORKER["min_score"], writer)
+    writer.close()
+
+    return fh.getvalue()
+
+
+def clean(args):
 
-        if qvalue:
-            print("@%s\n%s\n+\n%s" % (name, seq, qvalue))
+    writer = open_writer(output_name(args.out, args.compress), args.compress, threads=args.threads)
+
+    for file in args.fastq:
+        if args.threads > 1 and can_split(file):
+            # split the plain fastq into byte ranges cleaned by processes
+            for data in map_ranges(_clean_range, file, args.threads, _init_worker, (args.min_score,)):
+                writer.write(data)
+        else:
+            fp = open_fastq(file, threads=args.threads)
+            LOG.info("Parsing seq from %r" % file)
+            _clean_records(scan_fastq(fp), args.min_score, writer)
+            if file != "-":
+                fp.close()
+
+    writer.close()
 
 
 def main():
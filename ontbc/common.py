@@ -4,10 +4,12 @@
 """
 library for common functions
 """
-import gzip
+import sys
 import os.path
 import logging
 
+from ontbc.fastq import iter_fastq
+
 
 LOG = logging.getLogger(__name__)
 
@@ -29,75 +31,26 @@ def read_tsv(file, sep=None):
         yield line.split(sep)
 
 
-def readfq(file):  # this is a generator function
+def readfq(file, threads=1):
     """
-    modified from "https://github.com/lh3/readfq"
+    read fastq records as str, kept for callers of the old line by line
+    readfq, the records are read by ontbc.fastq.iter_fastq
     :param file: filename
-    :return:
-    """
-    if file.endswith(".gz"):
-        fp = gzip.open(file)
-    elif file.endswith(".fastq") or file.endswith(".fq"):
-        fp = open(file)
-    else:
-        raise Exception("%r file format error" % file)
-
-    LOG.info("Parsing seq from %r" % file)
-
-    last = None # this is a buffer keeping the last unprocessed line
-    while True: # mimic closure; is it a bad idea?
-        if not last: # the first record or a record following a fastq
-            for l in fp: # search for the start of the next record
-                if l[0] in '>@': # fasta/q header line
-                    last = l[:-1] # save this line
-                    break
-        if not last: break
-        name, seqs, last = last[1:], [], None
-        for l in fp: # read the sequence
-            if l[0] in '@+':
-                last = l[:-1]
-                break
-            seqs.append(l[:-1])
-        if not last or last[0] != '+': # this is a fasta record
-            yield name, ''.join(seqs), None # yield a fasta record
-            if not last: break
-        else: # this is a fastq record
-            seq, leng, seqs = ''.join(seqs), 0, []
-            for l in fp: # read the quality
-                seqs.append(l[:-1])
-                leng += len(l) - 1
-
-                if leng == len(seq): # have read enough quality
-                    last = None
-                    yield name, seq, ''.join(seqs); # yield a fastq record
-                    break
-                else:
-                    LOG.warning("read %r seq length != quality length" % name.split()[0])
-                    last = None
-                    break
-            if last: # reach EOF before reading enough quality
-                yield name, seq, None # yield a fasta record instead
-                break
-
-
-def n50(lengths):
-    """
-    return N50 of lengths
-    :param lengths: a list of length
-    :return:
+    :param threads: threads to inflate .gz
+    :return: generator of (name, seq, qual)
     """
-    assert lengths, "lengths %r is empty" % lengths
+    return iter_fastq(file, threads=threads, text=sys.version[0] == "3")
 
-    sum_length = sum(lengths)
-    accu_len = 0
 
-    for i in sorted(lengths, reverse=True):
-        accu_len += i
-
-        if accu_len >= sum_length*50/100:
-            return i
+def file_stamp(file):
+    """
+    the size and mtime of a file, used to check whether a cache is stale
+    :param file: filename
+    :return: str
+    """
+    st = os.stat(file)
 
-    return i
+    return "%s\t%s" % (st.st_size, int(st.st_mtime))
 
 
 def link(source, target, force=False):
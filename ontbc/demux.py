@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+native demultiplexer, the ends of reads are searched for the barcodes with
+the bit-parallel edit distance of Myers, all barcodes at once
+"""
+import io
+import os
+import sys
+import argparse
+import logging
+from multiprocessing import Pool
+
+from ontbc.parser import add_demux_parser
+from ontbc.common import mkdir, read_tsv
+from ontbc.fastq import open_fastq, scan_fastq
+from ontbc.parallel import can_split, scan_range, map_ranges
+from ontbc.writer import FastqWriter, open_writer, output_name
+from ontbc import __author__, __email__, __version__
+
+
+LOG = logging.getLogger(__name__)
+
+# ont barcodes 1-12, the native and the pcr barcoding kits share them
+BARCODES = (
+    ("BC01", "AAGAAAGTTGTCGGTGTCTTTGTG"),
+    ("BC02", "TCGATTCCGTTTGTAGTCGTCTGT"),
+    ("BC03", "GAGTCTTGTGTCCCAGTTACCAGG"),
+    ("BC04", "TTCGGATTCTATCGTGTTTCCCTA"),
+    ("BC05", "CTTGTCCAGGGTTTGTGTAACCTT"),
+    ("BC06", "TTCTCGCAAAGGCAGAAAGTAGTC"),
+    ("BC07", "GTGTTACCGTGGGAATGAATCCTT"),
+    ("BC08", "TTCAGGGAACAAACCAAGTTACGT"),
+    ("BC09", "AACTAGGCACAGCGAGTCTTGGTT"),
+    ("BC10", "AAGCGTTGAAACCTTTGTCCTCTC"),
+    ("BC11", "GTTTCATCTATCGGAGGGAATGGA"),
+    ("BC12", "CAGGTAGAAAGAAGCAGAATCGGA"),
+)
+# bases at each end of a read searched for barcodes
+END_SIZE = 150
+# minimum identity (%) of a barcode, as the default of porechop
+BARCODE_THRESHOLD = 75.0
+# minimum difference (%) between the best and the second barcode
+BARCODE_DIFF = 5.0
+# name of the reads without barcode, as porechop
+UNCLASSIFIED = "none"
+# bytes of records sent to a worker at a time, when the input can not be split
+BATCH_SIZE = 4 * 1024 * 1024
+
+_COMPLEMENT = dict(zip("ACGTNacgtn", "TGCANtgcan"))
+
+# the demultiplexer of a worker process, set by _init_worker
+_WORKER = {}
+
+
+def reverse_complement(seq):
+    return "".join(_COMPLEMENT.get(i, "N") for i in reversed(seq))
+
+
+class BarcodeMatcher(object):
+    """
+    the smallest edit distance of each barcode to a substring of a text,
+    with the bit-parallel algorithm of Myers (1999). each barcode is a lane
+    of one python int, so one step of the algorithm moves all barcodes by a
+    base of the text. a lane holds a barcode in its high bits under a guard
+    bit, the carries of the additions stop at the guard bit and the scores
+    of the lanes are packed in another int the same way.
+    """
+
+    def __init__(self, seqs):
+
+        self.lengths = [len(i) for i in seqs]
+        assert self.lengths and min(self.lengths) > 0, "barcodes are empty"
+
+        # a lane: zero bits, the barcode, the guard bit
+        self.width = width = max(self.lengths) + 2
+        self.mask = 0  # the bits of barcodes
+        self.low = 0  # the lowest bit of each lane
+        self.score = 0  # the length of each barcode, the score before any base
+        self.peq = [0] * 256  # the bits of each base in the barcodes
+
+        for n, seq in enumerate(seqs):
+            start = n * width + width - 1 - len(seq)
+            self.mask |= ((1 << len(seq)) - 1) << start
+            self.low |= 1 << (n * width)
+            self.score |= len(seq) << (n * width)
+
+            for i, base in enumerate(seq.upper()):
+                for c in (base, base.lower()):
+                    self.peq[ord(c)] |= 1 << (start + i)
+
+        self.guard = self.low << (width - 1)
+
+    def distances(self, text):
+        """
+        :param text: bytes
+        :return: list of the smallest edit distance of each barcode
+        """
+        mask, peq, low, guard, width = self.mask, self.peq, self.low, self.guard, self.width
+        shift = width - 2  # the top bit of the barcodes
+        pv = mask
+        mv = 0
+        score = best = self.score
+
+        for c in bytearray(text):
+            eq = peq[c]
+            xv = eq | mv
+            xh = ((((eq & pv) + pv) ^ pv) | eq) & mask
+            ph = (mv | ~(xh | pv)) & mask
+            mh = pv & xh
+            score += ((ph >> shift) & low) - ((mh >> shift) & low)
+            ph = (ph << 1) & mask
+            mh = (mh << 1) & mask
+            pv = (mh | ~(xv | ph)) & mask
+            mv = ph & xv
+
+            # best = min(best, score) in each lane, the guard bit of a lane
+            # is left set by the subtraction if best >= score
+            lower = (((best | guard) - score) & guard) >> (width - 1)
+            lower = (lower << width) - lower
+            best = (score & lower) | (best & ~lower)
+
+        lane = (1 << width) - 1
+
+        return [(best >> (n * width)) & lane for n in range(len(self.lengths))]
+
+
+class Demultiplexer(object):
+    """
+    assign reads to barcodes, the start of a read is searched for the
+    barcodes and the end for their reverse complement. a read goes to the
+    barcode of the best identity at either end, if it is >= threshold and
+    better than the other barcodes by diff.
+    """
+
+    def __init__(self, barcodes=BARCODES, threshold=BARCODE_THRESHOLD, diff=BARCODE_DIFF, end_size=END_SIZE):
+
+        self.names = [i[0] for i in barcodes]
+        self.lengths = [len(i[1]) for i in barcodes]
+        self.threshold = threshold
+        self.diff = diff
+        self.end_size = end_size
+        self.start = BarcodeMatcher([i[1] for i in barcodes])
+        self.end = BarcodeMatcher([reverse_complement(i[1]) for i in barcodes])
+
+    def identities(self, seq):
+        """
+        identity (%) of each barcode, the best of the two ends
+        :param seq: bytes
+        """
+        start = self.start.distances(seq[:self.end_size])
+        end = self.end.distances(seq[-self.end_size:])
+
+        return [100.0 * (n - min(i, j)) / n for n, i, j in zip(self.lengths, start, end)]
+
+    def assign(self, seq):
+        """
+        :param seq: bytes
+        :return: name of the barcode, UNCLASSIFIED if there is none
+        """
+        identities = self.identities(seq)
+        order = sorted(range(len(identities)), key=identities.__getitem__, reverse=True)
+        best = identities[order[0]]
+        second = identities[order[1]] if len(order) > 1 else 0
+
+        if best < self.threshold or best - second < self.diff:
+            return UNCLASSIFIED
+
+        return self.names[order[0]]
+
+
+def load_barcodes(file=None):
+    """
+    read barcodes from a file of name and sequence on each line
+    :param file: barcode file, None for BC01-BC12
+    :return: list of (name, sequence)
+    """
+    if not file:
+        return list(BARCODES)
+
+    r = [(i[0], i[1]) for i in read_tsv(file)]
+    LOG.info("Read %s barcodes from %r" % (len(r), file))
+
+    return r
+
+
+class BarcodeWriters(object):
+    """
+    a FastqWriter for each barcode, opened with its first read. without
+    out_dir the reads are kept in memory to be sent back from a worker
+    """
+
+    def __init__(self, out_dir=None, compress=False, threads=1):
+
+        self.out_dir = out_dir
+        self.compress = compress
+        self.threads = threads
+        self.writers = {}
+        self.reads = {}
+        self.bases = {}
+
+    def __getitem__(self, name):
+
+        if name not in self.writers:
+            if self.out_dir is None:
+                self.writers[name] = FastqWriter(io.BytesIO(), close=False)
+            else:
+                file = output_name(os.path.join(self.out_dir, "%s.fastq" % name), self.compress)
+                self.writers[name] = open_writer(file, self.compress, threads=self.threads)
+            self.reads[name] = 0
+            self.bases[name] = 0
+
+        return self.writers[name]
+
+    def count(self, name, reads, bases):
+
+        self[name]
+        self.reads[name] += reads
+        self.bases[name] += bases
+
+    def values(self):
+        """
+        the reads kept in memory
+        :return: dict of name -> (reads, bases, bytes)
+        """
+        r = {}
+
+        for name, writer in self.writers.items():
+            writer.flush()
+            r[name] = (self.reads[name], self.bases[name], writer.fh.getvalue())
+
+        return r
+
+    def merge(self, values):
+        """
+        write the reads of values, in memory from a worker
+        """
+        for name, (reads, bases, data) in values.items():
+            self[name].write(data)
+            self.count(name, reads, bases)
+
+    def close(self):
+
+        for writer in self.writers.values():
+            writer.close()
+
+
+def demux_records(records, demuxer, writers):
+    """
+    assign the records with qualities and write them to their barcode, like
+    clean the records without qualities are dropped
+    :param records: generator of scan_fastq
+    :param demuxer: Demultiplexer
+    :param writers: BarcodeWriters
+    :return: number of records written
+    """
+    n = 0
+
+    for buf, base, start, e1, e2, e3, e4 in records:
+        if e4 == e3 + 1:  # no qualities
+            continue
+
+        name = demuxer.assign(buf[e1+1:e2])
+        writers[name].write_scanned(buf, start, e1, e2, e3, e4)
+        writers.count(name, 1, e2 - e1 - 1)
+        n += 1
+
+    return n
+
+
+def _batches(records, size=BATCH_SIZE):
+    """
+    the raw bytes of records joined into batches of about size bytes
+    """
+    batch = []
+    nbytes = 0
+
+    for buf, base, start, e1, e2, e3, e4 in records:
+        batch.append(buf[start:e4])
+        batch.append(b"\n")
+        nbytes += e4 + 1 - start
+
+        if nbytes >= size:
+            yield b"".join(batch)
+            batch = []
+            nbytes = 0
+
+    if batch:
+        yield b"".join(batch)
+
+
+def _init_worker(barcodes, threshold, diff, end_size):
+    _WORKER["demuxer"] = Demultiplexer(barcodes, threshold, diff, end_size)
+
+
+def _demux_batch(data):
+    """
+    demultiplex a batch of records, run in a worker process
+    :return: dict of name -> (reads, bases, bytes)
+    """
+    writers = BarcodeWriters()
+    demux_records(scan_fastq(io.BytesIO(data)), _WORKER["demuxer"], writers)
+
+    return writers.values()
+
+
+def _demux_range(job):
+    """
+    demultiplex the records of a byte range, run in a worker process
+    :param job: (file, start, end)
+    :return: dict of name -> (reads, bases, bytes)
+    """
+    file, start, end = job
+    writers = BarcodeWriters()
+    demux_records(scan_range(file, start, end), _WORKER["demuxer"], writers)
+
+    return writers.values()
+
+
+def demux(args):
+
+    barcodes = load_barcodes(args.barcodes)
+    options = (barcodes, args.threshold, args.diff, args.end_size)
+    out_dir = mkdir(args.out_dir)
+    writers = BarcodeWriters(out_dir, args.compress)
+
+    for file in args.fastq:
+        LOG.info("Demultiplex %r with %s barcodes" % (file, len(barcodes)))
+
+        if args.threads > 1 and can_split(file):
+            # split the plain fastq into byte ranges demultiplexed by processes
+            for values in map_ranges(_demux_range, file, args.threads, _init_worker, options):
+                writers.merge(values)
+            continue
+
+        fp = open_fastq(file)
+
+        if args.threads > 1:
+            pool = Pool(args.threads, _init_worker, options)
+            try:
+                for values in pool.imap(_demux_batch, _batches(scan_fastq(fp))):
+                    writers.merge(values)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            demux_records(scan_fastq(fp), Demultiplexer(*options), writers)
+
+        if file != "-":
+            fp.close()
+
+    writers.close()
+
+    with open(os.path.join(out_dir, "barcodes.tsv"), "w") as fh:
+        fh.write("#Barcode\tReads number\tBases (bp)\n")
+
+        for name in [i[0] for i in barcodes] + [UNCLASSIFIED]:
+            if name in writers.reads:
+                LOG.info("%s: %s reads" % (name, writers.reads[name]))
+                fh.write("%s\t%s\t%s\n" % (name, writers.reads[name], writers.bases[name]))
+
+
+def main():
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format="[%(levelname)s] %(message)s"
+    )
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""
+Demultiplex ont reads by barcodes
+
+version: %s
+contact:  %s <%s>\
+    """ % (__version__, " ".join(__author__), __email__))
+
+    parser = add_demux_parser(parser)
+    args = parser.parse_args()
+    demux(args)
+
+
+if __name__ == "__main__":
+    main()
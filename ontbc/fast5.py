@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+sorted on-disk index of a fast5 list, basename -> path, opened with mmap.
+fast5 in tars are listed with the offset and size of their data, so they
+are copied out by seek
+"""
+import os.path
+import logging
+from array import array
+
+from ontbc.common import read_tsv, file_stamp
+from ontbc.table import OFFSET_TYPE, write_columns, read_columns
+from ontbc.writer import FastqWriter
+
+
+LOG = logging.getLogger(__name__)
+
+# columns of a summary naming the fast5 of a read, in the order they are looked for
+FAST5_COLUMNS = ("filename_fast5", "filename")
+
+
+class Fast5Index(object):
+    """
+    basenames of fast5 sorted with their paths, a basename is found by
+    binary search over the mmap of the index so the list is never loaded
+    """
+
+    def __init__(self, meta, columns):
+
+        self.stamp = meta["stamp"]
+        self.tars = meta["tars"]
+        self._name_offsets = columns["name_offsets"]
+        self._names = columns["names"]
+        self._path_offsets = columns["path_offsets"]
+        self._paths = columns["paths"]
+        self._tar_ids = columns["tar_ids"]  # -1 for a fast5 not in a tar
+        self._offsets = columns["offsets"]
+        self._sizes = columns["sizes"]
+
+    def __len__(self):
+        return len(self._name_offsets) - 1
+
+    def __contains__(self, name):
+        return self.find(name) is not None
+
+    def _name(self, row):
+        return bytes(self._names[self._name_offsets[row]:self._name_offsets[row+1]])
+
+    def _find(self, name):
+        """
+        row of a fast5 by its basename, -1 if not found
+        """
+        key = os.path.basename(name).encode("utf-8")
+        lo, hi = 0, len(self)
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo == len(self) or self._name(lo) != key:
+            return -1
+
+        return lo
+
+    def find(self, name):
+        """
+        path of a fast5 by its basename
+        :param name: basename of the fast5
+        :return: path, None if not found
+        """
+        row = self._find(name)
+
+        if row < 0:
+            return None
+
+        return bytes(self._paths[self._path_offsets[row]:self._path_offsets[row+1]]).decode("utf-8")
+
+    def locate(self, name):
+        """
+        where the data of a fast5 is
+        :param name: basename of the fast5
+        :return: (path, tar, offset, size), tar is None for a fast5 not in a tar,
+            None if not found
+        """
+        row = self._find(name)
+
+        if row < 0:
+            return None
+
+        path = bytes(self._paths[self._path_offsets[row]:self._path_offsets[row+1]]).decode("utf-8")
+        tar_id = self._tar_ids[row]
+
+        if tar_id < 0:
+            return path, None, 0, 0
+
+        return path, self.tars[tar_id], self._offsets[row], self._sizes[row]
+
+
+def f5i_path(file):
+    """
+    path of the index of a fast5 list
+    """
+    return "%s.f5i" % file
+
+
+def _build_f5i(file):
+    """
+    sort the fast5 of a list by basename, a basename listed twice keeps its
+    last path
+    :param file: fast5 list, a path on each line, followed by the tar, the
+        offset and the size of the data for a member of a tar
+    :return: (meta, list of (name, typecode, array)) for write_columns
+    """
+    LOG.info("Index fast5 list %r" % file)
+    records = {}
+
+    for record in read_tsv(file, sep="\t"):
+        records[os.path.basename(record[0])] = record
+
+    tars = {}
+    names = bytearray()
+    name_offsets = array(OFFSET_TYPE, [0])
+    data = bytearray()
+    path_offsets = array(OFFSET_TYPE, [0])
+    tar_ids = array("i")
+    offsets = array(OFFSET_TYPE)
+    sizes = array(OFFSET_TYPE)
+
+    for name in sorted(records, key=lambda i: i.encode("utf-8")):
+        record = records[name]
+        names += name.encode("utf-8")
+        name_offsets.append(len(names))
+        data += record[0].encode("utf-8")
+        path_offsets.append(len(data))
+
+        if len(record) >= 4:
+            tar_ids.append(tars.setdefault(record[1], len(tars)))
+            offsets.append(int(record[2]))
+            sizes.append(int(record[3]))
+        else:
+            tar_ids.append(-1)
+            offsets.append(0)
+            sizes.append(0)
+
+    return {"stamp": file_stamp(file), "tars": sorted(tars, key=tars.get)}, [
+        ("name_offsets", OFFSET_TYPE, name_offsets),
+        ("names", "B", names),
+        ("path_offsets", OFFSET_TYPE, path_offsets),
+        ("paths", "B", data),
+        ("tar_ids", "i", tar_ids),
+        ("offsets", OFFSET_TYPE, offsets),
+        ("sizes", OFFSET_TYPE, sizes),
+    ]
+
+
+def _save_f5i(file, meta, columns):
+    """
+    write the index of a fast5 list next to the list
+    :return: path of the index, None if it can not be written
+    """
+    path = f5i_path(file)
+
+    try:
+        write_columns(path, meta, columns)
+    except (IOError, OSError):
+        LOG.warning("can not write fast5 index %r" % path)
+        return None
+
+    LOG.info("Write %s fast5 to index %r" % (len(columns[0][2]) - 1, path))
+
+    return path
+
+
+def write_f5i(file):
+    """
+    sort the fast5 of a list by basename and write the index next to the list
+    :param file: fast5 list
+    :return: path of the index, None if it can not be written
+    """
+    return _save_f5i(file, *_build_f5i(file))
+
+
+def read_f5i(file):
+    """
+    open the index of a fast5 list
+    :param file: fast5 list
+    :return: Fast5Index, None if the index is missing or stale
+    """
+    path = f5i_path(file)
+
+    if not os.path.exists(path):
+        return None
+
+    r = read_columns(path)
+
+    if r is None or r[0].get("stamp") != file_stamp(file) or "tars" not in r[0]:
+        LOG.info("fast5 index %r is stale" % path)
+        return None
+
+    return Fast5Index(*r)
+
+
+def load_f5i(file):
+    """
+    open the index of a fast5 list, build it if it is missing or stale.
+    the index is kept in memory if it can not be written next to the list
+    :param file: fast5 list
+    :return: Fast5Index
+    """
+    r = read_f5i(file)
+
+    if r is not None:
+        return r
+
+    meta, columns = _build_f5i(file)
+
+    if _save_f5i(file, meta, columns) is not None:
+        r = read_f5i(file)
+
+    if r is None:
+        r = Fast5Index(meta, dict((name, column) for name, typecode, column in columns))
+
+    return r
+
+
+def fast5_column(head):
+    """
+    index of the column naming the fast5 of reads in the head of a summary
+    """
+    for i in FAST5_COLUMNS:
+        if i in head:
+            return head.index(i)
+
+    raise Exception("header of summary has no %s" % " or ".join(FAST5_COLUMNS))
+
+
+def extract_fast5(index, names, out_dir):
+    """
+    copy fast5 to out_dir, a fast5 in a tar is copied from the offset of
+    its data without reading the tar
+    :param index: Fast5Index
+    :param names: basenames of fast5
+    :param out_dir: output directory
+    :return: number of fast5 copied
+    """
+    tars = {}
+    n = 0
+
+    for name in names:
+        r = index.locate(name)
+
+        if r is None:
+            LOG.warning("fast5 %r not in the fast5 list" % name)
+            continue
+
+        path, tar, offset, size = r
+        if tar is None:
+            fp = open(path, "rb")
+            size = os.path.getsize(path)
+        else:
+            if tar not in tars:
+                tars[tar] = open(tar, "rb")
+            fp = tars[tar]
+
+        with FastqWriter(open(os.path.join(out_dir, os.path.basename(path)), "wb")) as writer:
+            writer.copy_range(fp, offset, size)
+
+        if tar is None:
+            fp.close()
+        n += 1
+
+    for fp in tars.values():
+        fp.close()
+
+    LOG.info("Copy %s fast5 to %r" % (n, out_dir))
+
+    return n
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+block buffered, bytes native fastq parser
+"""
+import sys
+import codecs
+import logging
+
+from ontbc.bgzf import open_gzip
+
+
+LOG = logging.getLogger(__name__)
+
+# bytes read from the file at a time
+BLOCK_SIZE = 256 * 1024
+# bytes compared with an item of a bytes object, int on python 3 and str on python 2
+_AT, _PLUS, _LF = b"@"[0], b"+"[0], b"\n"[0]
+# lines longer than this on average are found by find rather than split,
+# split tests every byte and find skips to the line end
+LONG_LINE = 2048
+
+
+def open_fastq(file, threads=1):
+    """
+    open a fastq file in binary mode, .gz is inflated in background threads
+    :param file: filename, .fastq, .fq or .gz, "-" for stdin
+    :param threads: threads to inflate bgzf blocks
+    :return: file object
+    """
+    if file == "-":
+        fp = sys.stdin.buffer if sys.version[0] == "3" else sys.stdin
+    elif file.endswith(".gz"):
+        fp = open_gzip(file, threads=threads)
+    elif file.endswith(".fastq") or file.endswith(".fq"):
+        fp = open(file, "rb")
+    else:
+        raise Exception("%r file format error" % file)
+
+    return fp
+
+
+def read_id(buf, start, end):
+    """
+    the read id, the first word of a header
+    :param buf: bytes
+    :param start: start of the header without "@"
+    :param end: end of the header
+    :return: str
+    """
+    name = buf[start:end].split(None, 1)
+
+    return name[0].decode("utf-8", "replace") if name else ""
+
+
+def _refill(fp, carry, block_size=BLOCK_SIZE):
+    """
+    read blocks after the bytes carried from the last block until the record
+    carried has its 4 line ends. only the new blocks are searched and the
+    blocks of a long record are joined once, so it is neither copied nor
+    searched again for each block
+    :param fp: binary file object
+    :param carry: bytes of the last block not scanned, from a line start
+    :param block_size: bytes read at a time
+    :return: (bytes, eof), ending with a line end at the end of the file
+    """
+    parts = [carry]
+    need = _missing_lf(carry, 4)  # line ends missing for the carried record
+    eof = False
+
+    while True:
+        block = fp.read(block_size)
+
+        if not block:
+            eof = True
+            break
+
+        parts.append(block)
+        need = _missing_lf(block, need)
+
+        if need <= 0:
+            break
+
+    if eof and (carry or len(parts) > 1) and parts[-1][-1:] != b"\n":
+        parts.append(b"\n")
+
+    return b"".join(parts), eof
+
+
+def _missing_lf(data, need):
+    """
+    the line ends still missing after data, found by find, which unlike
+    count stops at the last one needed
+    """
+    end = -1
+
+    while need > 0:
+        end = data.find(b"\n", end + 1)
+        if end < 0:
+            break
+        need -= 1
+
+    return need
+
+
+def scan_fastq(fp, block_size=BLOCK_SIZE):
+    """
+    scan 4-line fastq records from a binary file object.
+    the file is read in blocks and the line ends of each record are found
+    with bytes.find, a record crossing blocks is carried to the next block
+    by _refill. broken records are skipped with a warning like readfq.
+    :param fp: binary file object
+    :param block_size: bytes read at a time
+    :return: generator of (buf, base, start, e1, e2, e3, e4), buf is the
+             current block, base is the offset of buf in the (uncompressed)
+             stream, start is the position of "@" and e1-e4 are the
+             positions of the 4 line ends of the record in buf
+    """
+    buf = b""
+    base = 0  # offset of buf[0] in the stream
+    eof = False
+
+    while not eof:
+        buf, eof = _refill(fp, buf, block_size)
+
+        if not buf:
+            break
+
+        find = buf.find
+        size = len(buf)
+        pos = 0
+
+        while True:
+            e1 = find(b"\n", pos)
+            if e1 < 0:
+                break
+
+            if buf[pos] != _AT:  # search for the start of the next record
+                pos = e1 + 1
+                continue
+
+            e2 = find(b"\n", e1 + 1)
+            if e2 < 0:
+                break
+
+            if e2 + 2 < size and buf[e2+1] == _PLUS and buf[e2+2] == _LF:
+                e3 = e2 + 2
+            else:
+                e3 = find(b"\n", e2 + 1)
+                if e3 < 0:
+                    break
+
+                if buf[e2+1] != _PLUS:
+                    LOG.warning("read %r is truncated" % read_id(buf, pos+1, e1))
+                    pos = e1 + 1
+                    continue
+
+            e4 = find(b"\n", e3 + 1)
+            if e4 < 0:
+                break
+
+            if e2 - e1 != e4 - e3:
+                LOG.warning("read %r seq length != quality length" % read_id(buf, pos+1, e1))
+                pos = e4 + 1
+                continue
+
+            yield buf, base, pos, e1, e2, e3, e4
+            pos = e4 + 1
+
+        if eof and buf[pos:].strip():
+            LOG.warning("reach EOF before reading a complete record")
+
+        buf = buf[pos:]
+        base += pos
+
+
+def _scan_fields(fp, block_size=BLOCK_SIZE, text=False, close=False):
+    """
+    the fields of the records of scan_fastq, each block is split into lines
+    at once and the records are checked as scan_fastq does line by line
+    :param fp: binary file object
+    :param block_size: bytes read at a time
+    :param text: str instead of bytes, the name is decoded as utf-8, the
+        seq and qual as latin-1
+    :param close: close fp at the end
+    :return: generator of (name, seq, qual)
+    """
+    buf = b""
+    eof = False
+
+    while not eof:
+        buf, eof = _refill(fp, buf, block_size)
+
+        if not buf:
+            break
+
+        if buf.count(b"\n", 0, 8 * LONG_LINE) < 8:
+            # long lines, decoded field by field from views of buf, not copies
+            lines = _split_lines(buf, b"\n", memoryview(buf) if text else buf)
+            decode = text
+            at, plus = b"@", b"+"
+        else:
+            # the names are decoded again as utf-8 unless all is ascii
+            ascii = text and (buf.isascii() if hasattr(buf, "isascii") else False)
+            data = buf.decode("ascii" if ascii else "latin-1") if text else buf
+            lf, at, plus = ("\n", "@", "+") if text else (b"\n", b"@", b"+")
+            lines = data.split(lf)
+            decode = False
+
+        n = len(lines) - 1  # the last one has no line end
+        i = 0
+
+        while i < n:
+            head = lines[i]
+
+            if head[:1] != at:  # search for the start of the next record
+                i += 1
+                continue
+
+            if i + 2 >= n:
+                break
+
+            if lines[i+2][:1] != plus:
+                LOG.warning("read %r is truncated" % _line_id(head))
+                i += 1
+                continue
+
+            if i + 3 >= n:
+                break
+
+            seq = lines[i+1]
+            qual = lines[i+3]
+
+            if len(seq) != len(qual):
+                LOG.warning("read %r seq length != quality length" % _line_id(head))
+                i += 4
+                continue
+
+            if decode:
+                yield (head[1:].tobytes().decode("utf-8"),
+                       codecs.latin_1_decode(seq)[0], codecs.latin_1_decode(qual)[0])
+            elif not text or ascii:
+                yield head[1:], seq, qual
+            else:
+                yield head[1:].encode("latin-1").decode("utf-8"), seq, qual
+            i += 4
+
+        # the lines not scanned are carried, a slice of buf from their start
+        rest = lines[i:]
+        buf = buf[len(buf) - sum(len(j) for j in rest) - len(rest) + 1:]
+
+        if eof and buf.strip():
+            LOG.warning("reach EOF before reading a complete record")
+
+    if close:
+        fp.close()
+
+
+def _split_lines(data, lf, view=None):
+    """
+    data.split(lf), the line ends are found by find, which is faster than
+    split on long lines. the lines are sliced from view if given
+    """
+    r = []
+    find = data.find
+    view = data if view is None else view
+    start = 0
+
+    while True:
+        end = find(lf, start)
+
+        if end < 0:
+            r.append(view[start:])
+            return r
+
+        r.append(view[start:end])
+        start = end + 1
+
+
+def _line_id(head):
+    """
+    the read id of a header line, bytes, a memoryview or str of latin-1
+    """
+    if isinstance(head, memoryview):
+        head = head.tobytes()
+    elif not isinstance(head, bytes):
+        head = head.encode("latin-1")
+
+    return read_id(head, 1, len(head))
+
+
+def iter_fastq(file, block_size=BLOCK_SIZE, threads=1, text=False):
+    """
+    read fastq records as bytes
+    :param file: filename
+    :param block_size: bytes read at a time
+    :param threads: threads to inflate bgzf blocks
+    :param text: str instead of bytes, the name is decoded as utf-8, the
+        seq and qual as latin-1
+    :return: generator of (name, seq, qual)
+    """
+    fp = open_fastq(file, threads=threads)
+    LOG.info("Parsing seq from %r" % file)
+
+    return _scan_fields(fp, block_size, text, close=True)
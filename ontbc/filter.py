@@ -1,168 +1,627 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
 import sys
 import argparse
 import logging
+import struct
 import os.path
+import tempfile
+from itertools import compress
 
 from ontbc.parser import add_filter_parser
-from ontbc.common import read_tsv, n50, readfq
+from ontbc.fastq import open_fastq, scan_fastq, read_id
+from ontbc.index import read_fqi, write_fqi, open_fqi, has_fqi, fetch_records, copy_spans
+from ontbc.table import ReadTable, pack_id
+from ontbc.parallel import can_split, scan_range, map_ranges
+from ontbc.writer import FastqWriter, open_writer, output_name
+from ontbc.qscore import mean_qscore
+from ontbc.bgzf import is_bgzf, BgzfRandomReader
+from ontbc.summary import load_summary, read_cache
+from ontbc.common import mkdir
+from ontbc.fast5 import load_f5i, fast5_column, extract_fast5
+from ontbc.stats import STAT_HEAD, LengthStats, length_stats
 from ontbc import __author__, __email__, __version__
 
 
 LOG = logging.getLogger(__name__)
 
+# options of the filter in a worker process, set by _init_worker
+_WORKER = {}
+
+# bytes of memory held for each read when the whole fastq is filtered in memory,
+# the row of the ReadTable with its hash slots and the flag
+READ_MEMORY = 64
+# bytes of a row of a summary parsed in memory, the row of its ReadTable and the score
+SUMMARY_MEMORY = 56
+# bytes of a read id which is not an uuid, kept in a dict of the table besides its characters
+NAME_MEMORY = 100
+# ratio of uncompressed to compressed size assumed for .gz fastq
+GZ_RATIO = 3
+# records (and summary lines) read to estimate the mean size of records
+SAMPLE_RECORDS = 1000
+# a record spilled for the selection by total bases: length, size, offset in the source, summary row
+SPILL_RECORD = struct.Struct("<IIQq")
+# a summary row spilled
+SPILL_ROW = struct.Struct("<q")
+# records spilled or read back at a time
+SPILL_BATCH = 65536
+
 
 def get_summary(summary):
     """
-    read summary file into dict
+    read the columns used by filter from summary file, or its cache
     :param summary: summary file
-    :return: dict
+    :return: Summary
     """
-    r = {}
-    LOG.info("Parse ont summary from %r" % summary)
-
-    summary_iter = read_tsv(summary, sep=None)
-    if sys.version[0] == "3":
-        head = next(summary_iter)
-    else:
-        head = summary_iter.next()
+    return load_summary(summary, columns=("mean_qscore_template",))
 
-    if "read_id" in head:
-        read_index = head.index("read_id")
-        r["read_id"] = head
-    else:
-        raise Exception("header of summary has no read_id")
 
-    for record in summary_iter:
-        if record[read_index] != "read_id":
-            r[record[read_index]] = record
+def get_summary_cache(summary):
+    """
+    open the summary from its cache with mmap, the cache is built first if it
+    is missing or stale, so the parsed columns are not held while filtering
+    :param summary: summary file
+    :return: Summary, parsed in memory if the cache can not be written
+    """
+    r = get_summary(summary)
 
-    return r
+    return read_cache(summary, ("mean_qscore_template",)) or r
 
 
-def get_fast5(fast5):
+def _select_bases(lengths, keep, max_bases):
     """
-    read fast5 file into dict
-    :param fast5: summary file
-    :return: dict
+    keep the longest reads until the bases before a read > max_bases. the
+    cutoff length is found from the bases of each length instead of sorting
+    the reads, the reads with the cutoff length are kept in their order
+    :param lengths: lengths of reads
+    :param keep: bytearray, 1 for the reads to count, changed in place
+    :param max_bases: maximum number of total bases
+    :return: keep
     """
-    r = {}
-    LOG.info("Parse fast5 from %r" % fast5)
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
 
-    for record in read_tsv(fast5, sep="\t"):
-        r[os.path.basename(record[0])] = record[0]
+    if np is not None:
+        lengths = np.frombuffer(lengths, dtype=np.uint32)
+        mask = np.frombuffer(keep, dtype=np.uint8)
+        kept = lengths[mask == 1]
+        bases = np.bincount(kept, weights=kept)[::-1].cumsum()
+        over = np.flatnonzero(bases > max_bases)
 
-    return r
+        if not len(over):  # all reads are needed
+            return keep
+
+        cutoff = len(bases) - 1 - int(over[0])
+        sum_bases = int(bases[over[0]]) - int(np.count_nonzero(kept == cutoff)) * cutoff
+        n = (max_bases - sum_bases) // cutoff + 1  # reads with the cutoff length to keep
+
+        mask[lengths < cutoff] = 0
+        mask[np.flatnonzero((mask == 1) & (lengths == cutoff))[n:]] = 0
+
+        return keep
 
+    bases = {}
+    for v in compress(lengths, keep):
+        bases[v] = bases.get(v, 0) + v
 
-def get_length(file):
+    sum_bases = 0
+    for cutoff in sorted(bases, reverse=True):
+        if sum_bases + bases[cutoff] > max_bases:
+            break
+        sum_bases += bases[cutoff]
+    else:  # all reads are needed
+        return keep
+
+    for row in compress(range(len(keep)), keep):
+        v = lengths[row]
+
+        if v > cutoff:
+            continue
+        if v < cutoff or sum_bases > max_bases:
+            keep[row] = 0
+        else:
+            sum_bases += cutoff
+
+    return keep
+
+
+def _pass_score(summary, scores, _id, min_score):
     """
-    get the length and id of reads
-    :param file: fastq file
-    :return: id and length dict
+    whether a read is in summary and its score >= min_score
     """
-    r = {}
-    LOG.info("Get sequence length")
-    for name, seq, qual in readfq(file):
-        r[name] = len(seq)
+    summary_row = summary.find(_id)
 
-    return r
+    if summary_row < 0:
+        LOG.warning("read %r not in summary" % _id)
+        return False
 
+    if scores[summary_row] < min_score:  # filter by qscore
+        LOG.info("read %r score < %s" % (_id, min_score))
+        return False
+
+    return True
 
-def _filter_reads(length_dict, summary_dict, min_score, min_length, max_bases):
-    """
 
-    :param length_dict:
-    :param summary_dict:
+def _filter_reads(table, summary, min_score, min_length, max_bases):
+    """
+    filter reads in one pass over the table, with max_bases the longest
+    reads are kept, the reads with the cutoff length in their order
+    :param table: ReadTable
+    :param summary: Summary or None
     :param min_score:
     :param min_length:
     :param max_bases:
-    :return:
+    :return: bytearray, 1 for the rows kept
     """
-    r = {}
-
-    sum_bases = 0
+    lengths = table.lengths
 
-    assert min_score and summary_dict or not min_score and not summary_dict, "--min_score and --summary must be defined"
+    assert min_score and summary or not min_score and not summary, "--min_score and --summary must be defined"
 
     if min_length:
         LOG.info("Filter sequences with score >= %s, length >= %s" % (min_score, min_length))
     else:
         LOG.info("Filter sequences with score >= %s, total bases >= %s" % (min_score, max_bases))
 
-    if summary_dict:
-        score_index = summary_dict["read_id"].index("mean_qscore_template")
+    if summary:
+        r = bytearray(len(table))
+        scores = summary.columns["mean_qscore_template"]
 
-        for k, v in sorted(length_dict.items(), key=lambda d: d[1], reverse=True):
+        for row in range(len(table)):
 
-            _id = k.split()[0]
-            if _id not in summary_dict:
-                LOG.warning("read %r not in summary" % k)
+            if lengths[row] < min_length:  # filter by length
                 continue
 
-            if float(summary_dict[_id][score_index]) < min_score:  # filter by qscore
-                LOG.info("read %r score < %s" % (_id, min_score))
-                continue
+            if _pass_score(summary, scores, table.read_id(row), min_score):
+                r[row] = 1
+    else:
+        r = bytearray(v >= min_length for v in lengths)  # filter by length
 
-            if v < min_length:  # filter by length
-                break
+    if not max_bases:
+        return r
 
-            sum_bases += v
-            r[k] = v
+    return _select_bases(lengths, r, max_bases)  # filter by total bases
 
-            if max_bases and sum_bases > max_bases:  # filter by total bases
-                break
+
+def _filter_records(records, summary, min_score, min_length, writer=None):
+    """
+    decide each record of a scan and write the raw records passed, as
+    spans of the blocks read, without decoding seq and qual
+    :param records: generator of scan_fastq
+    :param summary: Summary or None
+    :param min_score:
+    :param min_length:
+    :param writer: FastqWriter, None to not write
+    :return: (ReadTable of all reads, bytearray of the rows passed)
+    """
+    table = ReadTable()
+    keep = bytearray()
+    scores = summary.columns["mean_qscore_template"] if summary else None
+
+    for buf, base, start, e1, e2, e3, e4 in records:
+        _id = read_id(buf, start+1, e1)
+        length = e2 - e1 - 1
+        table.add(_id, length, base + start, e4 + 1 - start)
+
+        if length < min_length:  # filter by length
+            passed = False
+        elif summary:
+            passed = _pass_score(summary, scores, _id, min_score)
+        elif min_score is not None and mean_qscore(buf[e3+1:e4]) < min_score:  # filter by qualities
+            LOG.info("read %r score < %s" % (_id, min_score))
+            passed = False
+        else:
+            passed = True
+
+        if passed:
+            keep.append(1)
+            if writer is not None:
+                writer.write_span(buf, start, e4 + 1)
+        else:
+            keep.append(0)
+
+    return table, keep
+
+
+def _filter_one_pass(file, summary, min_score, min_length, max_bases, out, tmp_dir=None, threads=1):
+    """
+    filter a fastq reading it only once, each record is decided and written
+    as it is read. with max_bases the reads passed are spooled to a temporary
+    file and the longest of them are copied from the spool at the end.
+    without summary the score of reads is the mean score of their qualities.
+    :param file: fastq file
+    :param summary: Summary or None
+    :param min_score:
+    :param min_length:
+    :param max_bases:
+    :param out: FastqWriter of the filtered fastq
+    :param tmp_dir: directory of the spool
+    :param threads: threads to inflate .gz
+    :return: (ReadTable of all reads, bytearray of the rows kept)
+    """
+    assert min_score or not summary, "--min_score and --summary must be defined"
+    LOG.info("Filter sequences with score >= %s, length >= %s, total bases >= %s in one pass" % (
+        min_score, min_length, max_bases))
+
+    if max_bases:
+        spool = tempfile.TemporaryFile(dir=tmp_dir)
+        writer = FastqWriter(spool, close=False)
     else:
-        for k, v in sorted(length_dict.items(), key=lambda d: d[1], reverse=True):
+        spool = None
+        writer = out
 
-            if v < min_length:  # filter by length
-                break
+    fp = open_fastq(file, threads=threads)
+    LOG.info("Parsing seq from %r" % file)
 
-            sum_bases += v
-            r[k] = v
+    table, keep = _filter_records(scan_fastq(fp), summary, min_score, min_length, writer)
+    fp.close()
 
-            if max_bases and sum_bases > max_bases:  # filter by total bases
-                break
+    if spool is None:
+        return table, keep
+
+    # the spool holds the passed reads in order, select the longest by total bases
+    passed = bytearray(keep)
+    _select_bases(table.lengths, keep, max_bases)
+    spans = []
+    offset = 0
+
+    for row in compress(range(len(table)), passed):
+        if keep[row]:
+            spans.append((offset, table.sizes[row]))
+        offset += table.sizes[row]
+
+    writer.flush()
+    copy_spans(spool, spans, out)
+    spool.close()
+
+    return table, keep
+
+
+def _init_worker(summary, min_score, min_length, write):
+    """
+    set the options of the filter in a worker process, the summary is
+    opened from its cache written by the main process
+    """
+    _WORKER["summary"] = get_summary(summary) if summary else None
+    _WORKER["min_score"] = min_score
+    _WORKER["min_length"] = min_length
+    _WORKER["write"] = write
+
+
+def _filter_range(job):
+    """
+    filter the records of a byte range, run in a worker process
+    :param job: (file, start, end)
+    :return: (ReadTable, bytearray of the rows passed, raw records passed)
+    """
+    file, start, end = job
+    fh = io.BytesIO()
+    writer = FastqWriter(fh, close=False) if _WORKER["write"] else None
+
+    table, keep = _filter_records(scan_range(file, start, end), _WORKER["summary"],
+                                  _WORKER["min_score"], _WORKER["min_length"], writer)
+
+    if writer is not None:
+        writer.flush()
+
+    return table, keep, fh.getvalue()
+
+
+def _filter_parallel(file, summary, min_score, min_length, max_bases, out, threads):
+    """
+    filter a plain fastq split into byte ranges on threads processes, the
+    results are merged in the order of the ranges so the output is the same
+    as _filter_one_pass. with max_bases the records kept are copied from the
+    fastq by offset after the selection.
+    :param file: plain fastq file
+    :param summary: summary file or None
+    :param min_score:
+    :param min_length:
+    :param max_bases:
+    :param out: FastqWriter of the filtered fastq
+    :param threads: number of processes
+    :return: (ReadTable of all reads, bytearray of the rows kept)
+    """
+    assert min_score or not summary, "--min_score and --summary must be defined"
+    LOG.info("Filter sequences with score >= %s, length >= %s, total bases >= %s with %s processes" % (
+        min_score, min_length, max_bases, threads))
+
+    tables = []
+    keep = bytearray()
+
+    for table, passed, data in map_ranges(_filter_range, file, threads, _init_worker,
+                                          (summary, min_score, min_length, not max_bases)):
+        tables.append(table)
+        keep += passed
+        out.write(data)
+
+    table = ReadTable.concat(tables)
+
+    if not max_bases:
+        return table, keep
+
+    _select_bases(table.lengths, keep, max_bases)
+    spans = [(table.offsets[row], table.sizes[row]) for row in compress(range(len(table)), keep)]
+
+    with open(file, "rb") as fp:
+        copy_spans(fp, spans, out)
+
+    return table, keep
+
+
+def estimate_memory(file, summary=None):
+    """
+    estimate the memory used to filter a fastq in memory, from the size of
+    the files, the mean size of the first records and of their read ids
+    :param file: fastq file
+    :param summary: summary file to parse in memory, None if it has a cache
+    :return: bytes
+    """
+    size = os.path.getsize(file)
+    if file.endswith(".gz"):
+        size *= GZ_RATIO
+
+    fp = open_fastq(file)
+    n = 0
+    nbytes = 0
+    names = 0  # bytes of the ids which are not packed as uuid
+
+    for buf, base, start, e1, e2, e3, e4 in scan_fastq(fp):
+        _id = read_id(buf, start+1, e1)
+        n += 1
+        nbytes += e4 + 1 - start
+        if not pack_id(_id)[1]:
+            names += NAME_MEMORY + len(_id)
+        if n >= SAMPLE_RECORDS:
+            break
+
+    fp.close()
+
+    if not nbytes:
+        return 0
+
+    r = size * n // nbytes * (READ_MEMORY + names // n)
+
+    if summary:
+        # a row for each line of the summary, with the ids seen in the fastq
+        lines = 0
+        nbytes = 0
+
+        with open(summary, "rb") as fh:
+            for line in fh:
+                lines += 1
+                nbytes += len(line)
+                if lines >= SAMPLE_RECORDS:
+                    break
+
+        if nbytes:
+            r += os.path.getsize(summary) * lines // nbytes * (SUMMARY_MEMORY + names // n)
 
     return r
 
-"""
-def plot_reads_number(lengths, window, x_max, x_min=0, mode="num"):
 
-    num = int((x_max - x_min) / window) + 1
-    x = [x_min + i * window for i in range(num)]
-    y = []
-    info = {i: [] for i in x}
+class _Spill(object):
+    """
+    records of fixed size written to a temporary file in batches and read
+    back in the order written, so they are not held in memory
+    """
+
+    def __init__(self, record, tmp_dir=None):
+
+        self.record = record
+        self.fh = tempfile.TemporaryFile(dir=tmp_dir)
+        self._buf = []
+
+    def add(self, *values):
+
+        self._buf.append(self.record.pack(*values))
 
-    for n in lengths:
-        if n in info:
-            info[n].append(n)
+        if len(self._buf) >= SPILL_BATCH:
+            self.fh.write(b"".join(self._buf))
+            self._buf = []
+
+    def batches(self):
+        """
+        read the records back
+        :return: generator of lists of tuples
+        """
+        self.fh.write(b"".join(self._buf))
+        self._buf = []
+        self.fh.seek(0)
+        size = self.record.size
+
+        while True:
+            data = self.fh.read(size * SPILL_BATCH)
+            if not data:
+                break
+            yield [self.record.unpack_from(data, i) for i in range(0, len(data), size)]
+
+    def close(self):
+        self.fh.close()
+
+
+def _bases_cutoff(stats, max_bases):
+    """
+    the cutoff length of the selection by total bases, like _select_bases
+    :param stats: LengthStats of the reads passed
+    :param max_bases: maximum number of total bases
+    :return: (cutoff, reads with the cutoff length to keep), None if all reads are kept
+    """
+    sum_bases = 0
+
+    for cutoff in sorted(stats.counts, reverse=True):
+        bases = cutoff * stats.counts[cutoff]
+
+        if sum_bases + bases > max_bases:
+            return cutoff, (max_bases - sum_bases) // cutoff + 1
+        sum_bases += bases
+
+    return None
+
+
+def _filter_external(file, summary, min_score, min_length, max_bases, out, tmp_dir=None, threads=1):
+    """
+    filter a fastq without holding the reads in memory. the index is written
+    line by line while the fastq is read once, with max_bases the reads
+    passed are spilled to a temporary file as (length, size, offset, summary
+    row) and the cutoff length is found from the counts of each length, so
+    the spill is only read back once in order to copy the reads kept.
+    :param file: fastq file
+    :param summary: Summary or None
+    :param min_score:
+    :param min_length:
+    :param max_bases:
+    :param out: FastqWriter of the filtered fastq
+    :param tmp_dir: directory of temporary files
+    :param threads: threads to inflate .gz
+    :return: (LengthStats of all reads, LengthStats of the reads kept, _Spill of the summary rows kept)
+    """
+    assert min_score or not summary, "--min_score and --summary must be defined"
+    LOG.info("Filter sequences with score >= %s, length >= %s, total bases >= %s out of memory" % (
+        min_score, min_length, max_bases))
+
+    raw_stats = LengthStats()
+    filter_stats = LengthStats()
+    rows = _Spill(SPILL_ROW, tmp_dir)
+    scores = summary.columns["mean_qscore_template"] if summary else None
+    fqi = None if has_fqi(file) else open_fqi(file)
+
+    source = spool = spill = None
+
+    if max_bases:
+        spill = _Spill(SPILL_RECORD, tmp_dir)
+        if can_split(file):
+            source = open(file, "rb")
+        elif is_bgzf(file):
+            source = BgzfRandomReader(file)
+        else:  # no seek in other .gz, the records passed are spooled
+            source = tempfile.TemporaryFile(dir=tmp_dir)
+            spool = FastqWriter(source, close=False)
+
+    fp = open_fastq(file, threads=threads)
+    LOG.info("Parsing seq from %r" % file)
+    spooled = 0
+
+    for buf, base, start, e1, e2, e3, e4 in scan_fastq(fp):
+        _id = read_id(buf, start+1, e1)
+        length = e2 - e1 - 1
+        size = e4 + 1 - start
+        raw_stats.add(length)
+
+        if fqi is not None:
+            fqi.add(_id, base + start, size, length)
+
+        if length < min_length:  # filter by length
             continue
-        pos = int(n / window) * window
 
-        if pos in info:
-            info[pos].append(n)
+        if summary:
+            summary_row = summary.find(_id)
+            if not _pass_score(summary, scores, _id, min_score):
+                continue
+        else:
+            summary_row = -1
+            if min_score is not None and mean_qscore(buf[e3+1:e4]) < min_score:  # filter by qualities
+                LOG.info("read %r score < %s" % (_id, min_score))
+                continue
 
-    y_num = len(lengths)
-    y_sum = sum(lengths)
+        filter_stats.add(length)
 
-    for i in x:
-        if mode == "base":
-            y.append(100.0 * sum(info[i]) / y_sum)
-        elif mode == "num":
-            y.append(100.0 * len(info[i]) / y_num)
+        if spill is None:
+            out.write_span(buf, start, e4 + 1)
+            rows.add(summary_row)
+        elif spool is not None:
+            spool.write_span(buf, start, e4 + 1)
+            spill.add(length, size, spooled, summary_row)
+            spooled += size
         else:
-            raise Exception("Unknown mode %r" % mode)
+            spill.add(length, size, base + start, summary_row)
 
-    return [i + window / 2 for i in x], y
+    fp.close()
+
+    if fqi is not None:
+        fqi.close()
+
+    if not max_bases:
+        return raw_stats, filter_stats, rows
+
+    if spool is not None:
+        spool.flush()
+
+    # filter by total bases, the longest reads and the first reads with the cutoff length
+    cutoff, n = _bases_cutoff(filter_stats, max_bases) or (0, 0)
+    filter_stats = LengthStats()
+
+    for batch in spill.batches():
+        spans = []
+
+        for length, size, offset, summary_row in batch:
+            if length < cutoff:
+                continue
+            if length == cutoff:
+                if not n:
+                    continue
+                n -= 1
+
+            spans.append((offset, size))
+            filter_stats.add(length)
+            rows.add(summary_row)
+
+        copy_spans(source, spans, out)
+
+    spill.close()
+    source.close()
+
+    return raw_stats, filter_stats, rows
+
+
+def plot_reads_number(stats, rows, window, mode="num"):
+    """
+    bars of the length plot, percent of reads or bases in each window
+    :param stats: LengthStats of all reads
+    :param rows: (start, reads, bases) of windows from LengthStats.distribution
+    :param window: width of the windows
+    :param mode: num or base
+    :return: (x, y)
+    """
+    if mode == "base":
+        y = [100.0 * bases / stats.sum if stats.sum else 0 for start, reads, bases in rows]
+    elif mode == "num":
+        y = [100.0 * reads / stats.count if stats.count else 0 for start, reads, bases in rows]
+    else:
+        raise Exception("Unknown mode %r" % mode)
+
+    return [start + window / 2.0 for start, reads, bases in rows], y
+
+
+def write_distribution(stats, window, x_max, out):
+    """
+    write the length distribution of reads in windows to out.tsv
+    :param stats: LengthStats of all reads
+    :param window: width of the windows
+    :param x_max: start of the last window
+    :param out: out prefix
+    :return: (start, reads, bases) of windows
+    """
+    LOG.info("Write reads distribution to %r" % ("%s.tsv" % out))
+    rows = stats.distribution(window, x_max)
 
+    with open("%s.tsv" % out, "w") as fh:
+        fh.write("#Length from (bp)\tLength to (bp)\tReads number\tBases (bp)\t% Number\t% Bases\n")
 
-def _plot(plt, lengths, window, x_max, mode, out):
+        for (start, reads, bases), num, base in zip(rows, plot_reads_number(stats, rows, window, "num")[1],
+                                                    plot_reads_number(stats, rows, window, "base")[1]):
+            fh.write("%s\t%s\t%s\t%s\t%.4f\t%.4f\n" % (start, start + window, reads, bases, num, base))
+
+    return rows
+
+
+def _plot(plt, stats, rows, window, mode, out):
 
     LOG.info("Plot reads distribution to %r" % out)
-    x, y = plot_reads_number(lengths, window, x_max, x_min=0, mode=mode)
+    x, y = plot_reads_number(stats, rows, window, mode=mode)
 
     fig, ax = plt.subplots(figsize=(8, 6), )
     plt.bar(x, y, width=window, linewidth=0.5, edgecolor=None)
@@ -179,104 +638,210 @@ def _plot(plt, lengths, window, x_max, mode, out):
     plt.xticks()
 
     plt.savefig("%s.png" % out, dpi=600)
-"""
+    plt.close(fig)
 
 
-def filter_reads(args):
+def _summary_rows(summary, table, keep):
+    """
+    rows in the summary of the reads kept
     """
+    for row in compress(range(len(table)), keep):
+        yield summary.find(table.read_id(row))
 
-    :param args:
-    :return:
+
+def _spilled_rows(rows):
+    """
+    summary rows read back from a _Spill
     """
-    raw_length_dict = get_length(args.fastq)
+    for batch in rows.batches():
+        for i in batch:
+            yield i[0]
 
-    if args.summary:
-        summary_dict = get_summary(args.summary)
-    else:
-        summary_dict = {}
-
-    filter_length_dict = _filter_reads(
-        length_dict=raw_length_dict,
-        summary_dict=summary_dict,
-        min_score=args.min_score,
-        min_length=args.min_length,
-        max_bases=args.max_bases
-    )
+    rows.close()
 
-    raw_lengths = raw_length_dict.values()
-    filter_lengths = filter_length_dict.values()
 
+def _write_fast5(summary, summary_rows, fast5, out, selected=None):
+    """
+    write the fast5 of the summary rows passing by, the fast5 is named by
+    the filename column of the summary and its path found in the index of
+    the fast5 list. the list is only created for at least one row
+    :param summary: Summary
+    :param summary_rows: iterable of summary rows
+    :param fast5: Fast5Index
+    :param out: output file
+    :param selected: list to add the names of the fast5 found to, once each
+    :return: generator of the summary rows
+    """
+    column = fast5_column(summary.head)
+    names = set()
+    fh = None
+
+    for summary_row in summary_rows:
+        name = summary.fields(summary_row)[column]
+        path = fast5.find(name)
+
+        if path is not None and selected is not None and name not in names:
+            names.add(name)
+            selected.append(name)
+
+        if path is None:
+            LOG.warning("fast5 %r not in the fast5 list" % name)
+        else:
+            if fh is None:
+                fh = open(out, "w")
+            fh.write("%s\n" % path)
+
+        yield summary_row
+
+    if fh is not None:
+        fh.close()
+
+
+def write_results(args, summary, raw_stats, filter_stats, summary_rows):
+    """
+    write the stats, the distributions of reads and the summary rows kept
+    :param args: options of filter
+    :param summary: Summary or None
+    :param raw_stats: LengthStats of all reads
+    :param filter_stats: LengthStats of the reads kept
+    :param summary_rows: iterable of the summary rows of the reads kept
     """
+    LOG.info("Output results")
+
+    out_stat = open("%s.reads_stat.tsv" % args.out, "w")
+    out_stat.write(STAT_HEAD)
+    out_stat.write(raw_stats.row("Raw Reads"))
+    out_stat.write(filter_stats.row("Filtered Reads"))
+    out_stat.close()
+
+    raw_rows = write_distribution(raw_stats, args.window, args.xmax, args.out + ".raw_reads")
+    filter_rows = write_distribution(filter_stats, args.window, args.xmax, args.out + ".filter_reads")
+
     if args.plot:
         import matplotlib
         matplotlib.use("Agg")
         from matplotlib import pyplot as plt
 
-        _plot(plt, lengths=raw_lengths,
+        _plot(plt, raw_stats, raw_rows,
               window=args.window,
-              x_max=args.xmax,
               mode=args.mode,
-              out=args.out+".raw_reads")
+              out=args.out + ".raw_reads")
 
-        _plot(plt, lengths=filter_lengths,
+        _plot(plt, filter_stats, filter_rows,
               window=args.window,
-              x_max=args.xmax,
               mode=args.mode,
               out=args.out + ".filter_reads")
-    """
-
-    LOG.info("Output results")
-
-    if len(filter_lengths) == 0:
-        filter_lengths = [0]
-
-    out_stat = open("%s.reads_stat.tsv" % args.out, "w")
-    out_stat.write("""\
-#Type\tBases (bp)\tReads number\tReads mean length (bp)\tReads N50 (bp)\tLongest Reads (bp)
-Raw Reads\t{0:,}\t{1:,}\t{2:,}\t{3:,}\t{4:,}
-Filtered Reads\t{5:,}\t{6:,}\t{7:,}\t{8:,}\t{9:,}
-""".format(
-        sum(raw_lengths), len(raw_lengths), int(sum(raw_lengths) / len(raw_lengths)), n50(raw_lengths),
-        max(raw_lengths),
-        sum(filter_lengths), len(filter_lengths), int(sum(filter_lengths) / len(filter_lengths)), n50(filter_lengths),
-        max(filter_lengths),
-    ))
-
-    out_stat.close()
 
     if args.fast5:
         assert os.path.exists(args.fast5)
-        fast5 = get_fast5(args.fast5)
+        fast5 = load_f5i(args.fast5)
 
-    read_out = []
+    selected = [] if args.fast5 and args.fast5_dir else None
 
-    out_fastq = open("%s.filtered.fastq" % args.out, "w")
+    if summary:
+        if args.fast5:
+            summary_rows = _write_fast5(summary, summary_rows, fast5, "%s.fast5.list" % args.out, selected)
 
-    if summary_dict:
-        out_summary = open("%s.filtered.summary.txt" % args.out, "w")
-        out_summary.write("\t".join(summary_dict["read_id"]) + "\n")
+        # copy the original rows by offset
+        out_summary = open("%s.filtered.summary.txt" % args.out, "wb")
+        summary.write_rows(summary_rows, out_summary)
+        out_summary.close()
+        summary.close()
 
-        for name, seq, qual in readfq(args.fastq):
+    if selected:
+        extract_fast5(fast5, selected, mkdir(args.fast5_dir))
 
-            if name in filter_length_dict:
-                _id = name.split()[0]
-                out_fastq.write("@%s\n%s\n+\n%s\n" % (name, seq, qual))
-                out_summary.write("\t".join(summary_dict[_id])+"\n")
 
-                if args.fast5:
-                    read_out.append("%s\n" % fast5[summary_dict[_id][0]])
+def filter_reads(args):
+    """
 
-        out_summary.close()
+    :param args:
+    :return:
+    """
+    # the memory is estimated before the summary is parsed, a summary with
+    # a cache is opened with mmap and takes no memory
+    if args.summary:
+        summary = read_cache(args.summary, ("mean_qscore_template",))
+    else:
+        summary = None
+
+    out_fastq = open_writer(output_name("%s.filtered.fastq" % args.out, args.compress),
+                            args.compress, threads=args.threads)
+
+    if args.max_memory and estimate_memory(args.fastq, args.summary if summary is None else None) > \
+            args.max_memory * 1024 * 1024:
+        # the reads do not fit in memory, keep only counts and spill the rest,
+        # the summary is read from its cache with mmap
+        LOG.info("Reads of %r need more than %s MB, filter out of memory" % (args.fastq, args.max_memory))
+
+        if args.summary and summary is None:
+            summary = get_summary_cache(args.summary)
+
+        raw_stats, filter_stats, rows = _filter_external(
+            file=args.fastq,
+            summary=summary,
+            min_score=args.min_score,
+            min_length=args.min_length,
+            max_bases=args.max_bases,
+            out=out_fastq,
+            tmp_dir=args.tmp_dir,
+            threads=args.threads
+        )
+        out_fastq.close()
+        write_results(args, summary, raw_stats, filter_stats, _spilled_rows(rows))
+        return
+
+    if args.summary and summary is None:
+        summary = get_summary(args.summary)
+
+    table = read_fqi(args.fastq)
+
+    if (table is None or (args.min_score is not None and not summary)) and \
+            args.threads > 1 and can_split(args.fastq):
+        # split the plain fastq into byte ranges filtered by processes
+        table, keep = _filter_parallel(
+            file=args.fastq,
+            summary=args.summary,
+            min_score=args.min_score,
+            min_length=args.min_length,
+            max_bases=args.max_bases,
+            out=out_fastq,
+            threads=args.threads
+        )
+        write_fqi(args.fastq, table)
+    elif table is None or (args.min_score is not None and not summary):
+        # no index yet, or the score is computed from the qualities,
+        # filter while reading the fastq once and index it on the way
+        table, keep = _filter_one_pass(
+            file=args.fastq,
+            summary=summary,
+            min_score=args.min_score,
+            min_length=args.min_length,
+            max_bases=args.max_bases,
+            out=out_fastq,
+            tmp_dir=args.tmp_dir,
+            threads=args.threads
+        )
+        write_fqi(args.fastq, table)
     else:
-        for name, seq, qual in readfq(args.fastq):
-            if name in filter_length_dict:
-                out_fastq.write("@%s\n%s\n+\n%s\n" % (name, seq, qual))
+        keep = _filter_reads(
+            table=table,
+            summary=summary,
+            min_score=args.min_score,
+            min_length=args.min_length,
+            max_bases=args.max_bases
+        )
+
+        # copy the selected records by offset instead of parsing the fastq again
+        spans = [(table.offsets[row], table.sizes[row]) for row in compress(range(len(table)), keep)]
+        fetch_records(args.fastq, spans, out_fastq, threads=args.threads)
 
     out_fastq.close()
 
-    if read_out:
-        with open("%s.fast5.list" % args.out, "w") as fh:
-            fh.write("".join(read_out))
+    # count the reads of each length once instead of sorting the lengths,
+    # the stats and the distributions are all made from the counts
+    write_results(args, summary, length_stats(table.lengths), length_stats(table.lengths, keep),
+                  _summary_rows(summary, table, keep) if summary else ())
 
 
 def main():
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+fastq offset index (.fqi), like the .fai of samtools but for fastq.
+each line of the index is: read id, offset, record size, sequence length
+"""
+import os.path
+import logging
+
+from ontbc.common import file_stamp
+from ontbc.fastq import BLOCK_SIZE, open_fastq
+from ontbc.table import ReadTable
+from ontbc.bgzf import is_bgzf, BgzfRandomReader
+from ontbc.writer import FastqWriter
+
+
+LOG = logging.getLogger(__name__)
+
+FQI_VERSION = "1"
+
+
+def fqi_path(file):
+    """
+    path of the index of a fastq
+    """
+    return "%s.fqi" % file
+
+
+class FqiWriter(object):
+    """
+    write the index of a fastq line by line, to a temporary name first so a
+    partial index is never read
+    """
+
+    def __init__(self, file):
+
+        self.file = file
+        self.path = fqi_path(file)
+        self._temp = "%s.%s.tmp" % (self.path, os.getpid())
+        self._fh = open(self._temp, "w")
+        self._fh.write("#fqi\t%s\t%s\n" % (FQI_VERSION, file_stamp(file)))
+
+    def add(self, read_id, offset, size, length):
+        self._fh.write("%s\t%s\t%s\t%s\n" % (read_id, offset, size, length))
+
+    def close(self):
+
+        self._fh.close()
+        os.rename(self._temp, self.path)
+        LOG.info("Write index to %r" % self.path)
+
+        return self.path
+
+
+def open_fqi(file):
+    """
+    open a FqiWriter of a fastq
+    :return: FqiWriter, None if the index can not be written
+    """
+    try:
+        return FqiWriter(file)
+    except (IOError, OSError):
+        LOG.warning("can not write index %r" % fqi_path(file))
+        return None
+
+
+def write_fqi(file, table):
+    """
+    cache the index of a fastq next to the fastq
+    :param file: fastq file
+    :param table: ReadTable with the offsets and sizes of the records
+    :return: path of the index, None if it can not be written
+    """
+    fh = open_fqi(file)
+
+    if fh is None:
+        return None
+
+    lengths, offsets, sizes = table.lengths, table.offsets, table.sizes
+
+    for row in range(len(table)):
+        fh.add(table.read_id(row), offsets[row], sizes[row], lengths[row])
+
+    return fh.close()
+
+
+def has_fqi(file):
+    """
+    whether the index of a fastq is cached and not stale
+    """
+    fqi = fqi_path(file)
+
+    if not os.path.exists(fqi):
+        return False
+
+    with open(fqi) as fh:
+        return fh.readline().rstrip("\n") == "#fqi\t%s\t%s" % (FQI_VERSION, file_stamp(file))
+
+
+def read_fqi(file):
+    """
+    read the cached index of a fastq
+    :param file: fastq file
+    :return: ReadTable, None if the index is missing or stale
+    """
+    fqi = fqi_path(file)
+
+    if not os.path.exists(fqi):
+        return None
+
+    fh = open(fqi)
+    if fh.readline().rstrip("\n") != "#fqi\t%s\t%s" % (FQI_VERSION, file_stamp(file)):
+        LOG.info("index %r is stale" % fqi)
+        fh.close()
+        return None
+
+    LOG.info("Read index from %r" % fqi)
+    r = ReadTable()
+
+    for line in fh:
+        read_id, offset, size, length = line.rstrip("\n").split("\t")
+        r.add(read_id, int(length), int(offset), int(size))
+
+    fh.close()
+
+    return r
+
+
+def _merge_spans(spans):
+    """
+    merge sorted (offset, size) spans which are next to each other
+    """
+    r = []
+
+    for offset, size in spans:
+        if r and r[-1][0] + r[-1][1] == offset:
+            r[-1][1] += size
+        else:
+            r.append([offset, size])
+
+    return r
+
+
+def copy_spans(fp, spans, out):
+    """
+    copy spans of a seekable file to out, spans next to each other are
+    copied at once, by os.sendfile if both are plain files
+    :param fp: binary file object
+    :param spans: (offset, size), sorted by offset
+    :param out: FastqWriter or binary file object
+    :return: number of spans
+    """
+    writer = out if isinstance(out, FastqWriter) else FastqWriter(out, close=False)
+    last = b"\n"
+
+    for offset, size in _merge_spans(spans):
+        last = writer.copy_range(fp, offset, size) or last
+
+        if last != b"\n":  # the last record of a file without "\n" at the end
+            writer.write(b"\n")
+
+    if writer is not out:
+        writer.flush()
+
+    return len(spans)
+
+
+def fetch_records(file, spans, out, threads=1):
+    """
+    copy records of a fastq to out by their offsets without parsing them,
+    plain and bgzf files are read with seek, other .gz files are streamed once
+    :param file: fastq file
+    :param spans: (offset, size) of records, sorted by offset
+    :param out: binary file object
+    :param threads: threads to inflate .gz
+    :return: number of records
+    """
+    if not file.endswith(".gz") or is_bgzf(file):
+        fp = BgzfRandomReader(file) if file.endswith(".gz") else open_fastq(file)
+        copy_spans(fp, spans, out)
+        fp.close()
+        return len(spans)
+
+    fp = open_fastq(file, threads=threads)
+
+    pos = 0
+    last = b"\n"
+
+    for offset, size in _merge_spans(spans):
+        while pos < offset:  # skip records not selected
+            data = fp.read(min(BLOCK_SIZE, offset - pos))
+            if not data:
+                break
+            pos += len(data)
+
+        pos = offset + size
+        while size > 0:
+            data = fp.read(min(BLOCK_SIZE, size))
+            if not data:
+                break
+            size -= len(data)
+            out.write(data)
+            last = data[-1:]
+
+        if last != b"\n":  # the last record of a file without "\n" at the end
+            out.write(b"\n")
+
+    fp.close()
+
+    return len(spans)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+split a fastq into byte ranges aligned to records, or a text file into
+ranges aligned to lines, and map them on a process pool
+"""
+import os.path
+import logging
+from multiprocessing import Pool
+
+from ontbc.fastq import BLOCK_SIZE, scan_fastq
+
+
+LOG = logging.getLogger(__name__)
+
+# bytes of fastq handled by one task at most
+CHUNK_SIZE = 64 * 1024 * 1024
+# bytes of a range at least
+MIN_CHUNK_SIZE = 1024 * 1024
+
+
+def record_start(fp, offset, size):
+    """
+    the first record start at or after offset, a line starting with "@"
+    whose third line starts with "+" and whose quality is as long as the sequence
+    :param fp: binary file object
+    :param offset: offset to search from
+    :param size: size of the file
+    :return: offset of the record, size if there is none
+    """
+    if offset <= 0:
+        return 0
+
+    window = MIN_CHUNK_SIZE
+
+    while True:
+        fp.seek(offset - 1)
+        buf = fp.read(window)
+        eof = offset - 1 + len(buf) >= size
+        pos = 0
+
+        while True:
+            pos = buf.find(b"\n@", pos)
+            if pos < 0:
+                break
+
+            start = pos + 1
+            e1 = buf.find(b"\n", start)
+            e2 = buf.find(b"\n", e1 + 1) if e1 >= 0 else -1
+            e3 = buf.find(b"\n", e2 + 1) if e2 >= 0 else -1
+            e4 = buf.find(b"\n", e3 + 1) if e3 >= 0 else -1
+
+            if e4 < 0 and e3 >= 0 and eof:  # the last record without "\n"
+                e4 = len(buf)
+            if e4 < 0:
+                break
+
+            if buf[e2+1:e2+2] == b"+" and e4 - e3 == e2 - e1:
+                return offset - 1 + start
+
+            pos = start
+
+        if eof:
+            return size
+
+        window *= 2
+
+
+def line_start(fp, offset, size):
+    """
+    the first line start at or after offset
+    :param fp: binary file object
+    :param offset: offset to search from
+    :param size: size of the file
+    :return: offset of the line, size if there is none
+    """
+    if offset <= 0:
+        return 0
+
+    fp.seek(offset - 1)
+    pos = offset - 1
+
+    while True:
+        buf = fp.read(MIN_CHUNK_SIZE)
+        if not buf:
+            return size
+
+        i = buf.find(b"\n")
+        if i >= 0:
+            return pos + i + 1
+
+        pos += len(buf)
+
+
+def can_split(file):
+    """
+    whether a fastq can be split into byte ranges, only plain files can
+    """
+    return not file.endswith(".gz") and os.path.isfile(file)
+
+
+def split_fastq(file, threads, chunk_size=CHUNK_SIZE):
+    """
+    split a fastq into byte ranges, each range starts at a record
+    :param file: plain fastq file
+    :param threads: number of workers, there are at least 4 ranges per worker
+    :param chunk_size: bytes of a range at most
+    :return: list of (start, end)
+    """
+    size = os.path.getsize(file)
+    chunk_size = max(min(chunk_size, size // (threads * 4)), MIN_CHUNK_SIZE)
+
+    with open(file, "rb") as fp:
+        starts = [record_start(fp, i, size) for i in range(0, size, chunk_size)]
+
+    bounds = sorted(set(starts + [size]))
+
+    return [(bounds[i], bounds[i+1]) for i in range(len(bounds) - 1)]
+
+
+def split_lines(file, threads, start=0, chunk_size=CHUNK_SIZE):
+    """
+    split a text file into byte ranges, each range starts at a line
+    :param file: plain text file
+    :param threads: number of workers, there are at least 4 ranges per worker
+    :param start: offset of the first line, to leave out a header
+    :param chunk_size: bytes of a range at most
+    :return: list of (start, end)
+    """
+    size = os.path.getsize(file)
+    chunk_size = max(min(chunk_size, (size - start) // (threads * 4)), MIN_CHUNK_SIZE)
+
+    with open(file, "rb") as fp:
+        starts = [start] + [line_start(fp, i, size) for i in range(start + chunk_size, size, chunk_size)]
+
+    bounds = sorted(set(starts + [size]))
+
+    return [(bounds[i], bounds[i+1]) for i in range(len(bounds) - 1)]
+
+
+def scan_range(file, start, end, block_size=BLOCK_SIZE):
+    """
+    scan the records starting in [start, end) of a plain fastq
+    :param file: plain fastq file
+    :param start: offset of the first record
+    :param end: end of the range
+    :param block_size: bytes read at a time
+    :return: generator like scan_fastq, base is the offset in the file
+    """
+    fp = open(file, "rb")
+    fp.seek(start)
+
+    for buf, base, pos, e1, e2, e3, e4 in scan_fastq(fp, block_size):
+        if start + base + pos >= end:
+            break
+        yield buf, start + base, pos, e1, e2, e3, e4
+
+    fp.close()
+
+
+def map_ranges(func, file, threads, initializer=None, initargs=()):
+    """
+    map func over the ranges of a fastq on a process pool
+    :param func: function of (file, start, end), defined at module level
+    :param file: plain fastq file
+    :param threads: number of processes
+    :param initializer: function to init each process
+    :param initargs: arguments of initializer
+    :return: generator of the results in the order of the ranges
+    """
+    ranges = split_fastq(file, threads)
+    LOG.info("Split %r into %s ranges for %s processes" % (file, len(ranges), threads))
+
+    pool = Pool(threads, initializer, initargs)
+
+    try:
+        for r in pool.imap(func, [(file, start, end) for start, end in ranges]):
+            yield r
+    finally:
+        pool.terminate()
+        pool.join()
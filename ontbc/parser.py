@@ -10,13 +10,17 @@ def add_filter_parser(parser):
     """
 
     parser.add_argument("--fastq", metavar="FILE", required=True,
-                        help=".fastq")
+                        help=".fastq or .fastq.gz")
     parser.add_argument("--summary", metavar="FILE", required=False,
                         help="Ont summary file")
     parser.add_argument("--min_score", metavar="NUM", type=float, required=False,
-                        help="Minimum number of read Q score. use with --summary")
+                        help="Minimum number of read Q score, from --summary or the mean of fastq qualities")
 
     parser.add_argument("--fast5", metavar="FILE", required=False, help="fast5 path file")
+    parser.add_argument("--fast5_dir", metavar="DIR", required=False,
+                        help="Copy the fast5 of the reads kept to DIR, fast5 in tars are read by offset")
+    parser.add_argument("--threads", type=int, metavar="INT",
+                        default=1, help="Processes to split a plain fastq, threads to inflate or compress .gz (default:1).")
 
     filter_group = parser.add_mutually_exclusive_group(required=False)
     filter_group.add_argument("--min_length", metavar="INT", type=int, default=0,
@@ -25,8 +29,8 @@ def add_filter_parser(parser):
                               help="Maximum number of total bases.")
 
     plot_group = parser.add_argument_group(title="Plot arguments")
-    # plot_group.add_argument("--plot", action="store_true",
-    #                        help="Plot reads distribution")
+    plot_group.add_argument("--plot", action="store_true",
+                            help="Plot reads distribution, matplotlib is required")
     plot_group.add_argument("--window", metavar="INT", type=int,
                             default=1000, help="Window to stat (default: 1000).")
     plot_group.add_argument("--xmax", metavar="INT", type=int,
@@ -34,6 +38,12 @@ def add_filter_parser(parser):
     plot_group.add_argument("--mode", choices=["num", "base"],
                             default="base", help="Type of y axis (default: base).")
 
+    parser.add_argument("--compress", action="store_true",
+                        help="Write the filtered fastq as .fastq.gz (bgzf).")
+    parser.add_argument("--tmp_dir", metavar="DIR",
+                        help="Directory of temporary files (default: system temp).")
+    parser.add_argument("--max_memory", metavar="MB", type=int,
+                        help="Filter out of memory if the reads need more than MB, reads are spilled to --tmp_dir (default: no limit).")
     parser.add_argument("--out",
                         default="out", help="out prefix (default: out).")
 
@@ -42,8 +52,64 @@ def add_filter_parser(parser):
 
 def add_clean_parser(parser):
 
-    parser.add_argument("fastq", metavar="FASTQ",
-                        help=".fastq")
+    parser.add_argument("fastq", metavar="FASTQ", nargs="+",
+                        help=".fastq or .fastq.gz, cleaned in order into one output, - for stdin")
+    parser.add_argument("--min_score", metavar="NUM", type=float, required=False,
+                        help="Minimum mean Q score of fastq qualities (default: no filter).")
+    parser.add_argument("--out", metavar="FILE", default="-",
+                        help="Output fastq, compressed if it ends with .gz (default: stdout).")
+    parser.add_argument("--compress", action="store_true",
+                        help="Compress the output as bgzf, .gz is added to --out.")
+    parser.add_argument("--threads", type=int, metavar="INT",
+                        default=1, help="Processes to split a plain fastq, threads to inflate or compress .gz (default:1).")
+
+    return parser
+
+
+def add_run_parser(parser):
+    """
+    parser for run tool
+    :param parser:
+    :return:
+    """
+
+    parser.add_argument("--fastq", metavar="FILE", required=True,
+                        help=".fastq or .fastq.gz, - for stdin")
+    parser.add_argument("--summary", metavar="FILE", required=False,
+                        help="Ont summary file, the score of reads is read from it")
+    parser.add_argument("--min_score", metavar="NUM", type=float, required=False,
+                        help="Minimum number of read Q score, from --summary or the mean of fastq qualities")
+    parser.add_argument("--min_length", metavar="INT", type=int, default=0,
+                        help="Minimum number of read length (default: 0).")
+    parser.add_argument("--threads", type=int, metavar="INT",
+                        default=1, help="Processes to split a plain fastq, threads to inflate or compress .gz (default:1).")
+    parser.add_argument("--compress", action="store_true",
+                        help="Write the fastq as .fastq.gz (bgzf).")
+    parser.add_argument("--out",
+                        default="out", help="out prefix (default: out).")
+
+    return parser
+
+
+def add_stats_parser(parser):
+    """
+    parser for stats tool
+    :param parser:
+    :return:
+    """
+
+    parser.add_argument("--summary", metavar="FILE", nargs="+",
+                        help="Ont summary files")
+    parser.add_argument("--fastq", metavar="FILE", nargs="+",
+                        help=".fastq or .fastq.gz files")
+    parser.add_argument("--min_score", metavar="NUM", type=float, default=7,
+                        help="Minimum Q score of pass reads (default: 7).")
+    parser.add_argument("--interval", metavar="NUM", type=float, default=60,
+                        help="Minutes of each row of the yield over time (default: 60).")
+    parser.add_argument("--threads", type=int, metavar="INT",
+                        default=1, help="Processes to use (default:1).")
+    parser.add_argument("--out",
+                        default="out", help="out prefix (default: out).")
 
     return parser
 
@@ -62,6 +128,40 @@ def add_barcode_parser(parser):
                         default="work", help="Work directory (default: work).")
     parser.add_argument("--out_dir", metavar="DIR",
                         default="out", help="Out directory (default: out).")
+    parser.add_argument("--engine", choices=["porechop", "native"], default="porechop",
+                        help="Demultiplex with porechop or the native demultiplexer of ontbc (default: porechop).")
+    parser.add_argument("--scratch", metavar="DIR",
+                        help="Local directory of the nodes for the cleaned reads of a task, e.g. /tmp (default: work directory).")
+    parser.add_argument("--chunk_size", metavar="MB", type=int, default=1024,
+                        help="Size of the fastq files in a barcoding task, 0 for a task per file (default: 1024).")
+    parser.add_argument("--compress", action="store_true",
+                        help="Write the fastq of each barcode as .fastq.gz (bgzf).")
 
     return parser
 
+
+def add_demux_parser(parser):
+    """
+    parser for demux tool
+    :param parser:
+    :return:
+    """
+
+    parser.add_argument("fastq", metavar="FASTQ", nargs="+",
+                        help=".fastq or .fastq.gz, - for stdin")
+    parser.add_argument("--barcodes", metavar="FILE",
+                        help="Barcodes, name and sequence on each line (default: BC01-BC12).")
+    parser.add_argument("--threshold", metavar="NUM", type=float, default=75.0,
+                        help="Minimum identity (%%) of a barcode at an end of reads (default: 75).")
+    parser.add_argument("--diff", metavar="NUM", type=float, default=5.0,
+                        help="Minimum identity (%%) of the best barcode over the second (default: 5).")
+    parser.add_argument("--end_size", metavar="INT", type=int, default=150,
+                        help="Bases at each end of reads searched for barcodes (default: 150).")
+    parser.add_argument("--threads", type=int, metavar="INT",
+                        default=1, help="Processes to demultiplex (default:1).")
+    parser.add_argument("--compress", action="store_true",
+                        help="Write the fastq of each barcode as .fastq.gz (bgzf).")
+    parser.add_argument("--out_dir", metavar="DIR", default=".",
+                        help="Directory of the fastq of each barcode, BC01.fastq ... none.fastq (default: .).")
+
+    return parser
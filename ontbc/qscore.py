@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+mean quality score of reads from their fastq quality strings
+"""
+import math
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+LOG = logging.getLogger(__name__)
+
+# error probability of each phred+33 quality char
+ERROR_PROB = [10 ** (-(i - 33) / 10.0) if i >= 33 else 1.0 for i in range(256)]
+
+if np is not None:
+    _ERROR_PROB = np.array(ERROR_PROB)
+
+
+def mean_qscore(qual):
+    """
+    mean quality score of a read, -10 * log10 of the mean error probability
+    of its bases, like the mean_qscore_template of the basecaller
+    :param qual: quality string, phred+33
+    :return: float
+    """
+    if not isinstance(qual, bytes):
+        qual = qual.encode("latin-1")
+
+    if not qual:
+        return 0.0
+
+    if np is not None:
+        error = float(np.bincount(np.frombuffer(qual, dtype=np.uint8), minlength=256).dot(_ERROR_PROB))
+    else:
+        error = sum(map(ERROR_PROB.__getitem__, bytearray(qual)))
+
+    return round(-10 * math.log10(error / len(qual)), 6)
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+clean, filter and stat a fastq in one pass, the steps are generator stages
+over the records of one parse and no file is written between them
+"""
+import io
+import sys
+import argparse
+import logging
+
+from ontbc.parser import add_run_parser
+from ontbc.fastq import open_fastq, scan_fastq, read_id
+from ontbc.parallel import can_split, scan_range, map_ranges
+from ontbc.qscore import mean_qscore
+from ontbc.summary import load_summary
+from ontbc.stats import STAT_HEAD, LengthStats
+from ontbc.writer import FastqWriter, open_writer, output_name
+from ontbc import __author__, __email__, __version__
+
+
+LOG = logging.getLogger(__name__)
+
+# stages of run in a worker process, set by _init_worker
+_WORKER = {}
+
+
+class Stage(object):
+    """
+    a step of the pipeline, counting the reads and bases in and out.
+    records are the tuples of scan_fastq, (buf, base, start, e1, e2, e3, e4)
+    """
+
+    name = "stage"
+
+    def __init__(self):
+
+        self.reads_in = 0
+        self.bases_in = 0
+        self.reads_out = 0
+        self.bases_out = 0
+
+    def keep(self, record):
+        """
+        whether a record goes on to the next stage
+        """
+        return True
+
+    def __call__(self, records):
+
+        for record in records:
+            length = record[4] - record[3] - 1
+            self.reads_in += 1
+            self.bases_in += length
+
+            if self.keep(record):
+                self.reads_out += 1
+                self.bases_out += length
+                yield record
+
+    def merge(self, other):
+        """
+        add the counters of the same stage run on another part of the input
+        :return: self
+        """
+        self.reads_in += other.reads_in
+        self.bases_in += other.bases_in
+        self.reads_out += other.reads_out
+        self.bases_out += other.bases_out
+
+        return self
+
+    def row(self):
+        """
+        a line of stages.tsv
+        """
+        return "%s\t%s\t%s\t%s\t%s\n" % (self.name, self.reads_in, self.bases_in, self.reads_out, self.bases_out)
+
+
+class CleanStage(Stage):
+    """
+    drop records without qualities, like clean
+    """
+
+    name = "clean"
+
+    def keep(self, record):
+        return record[6] > record[5] + 1
+
+
+class LengthStage(Stage):
+    """
+    drop reads shorter than min_length
+    """
+
+    name = "length"
+
+    def __init__(self, min_length):
+
+        Stage.__init__(self)
+        self.min_length = min_length
+
+    def keep(self, record):
+        return record[4] - record[3] - 1 >= self.min_length
+
+
+class ScoreStage(Stage):
+    """
+    drop reads with a score < min_score, the score is read from the summary
+    if there is one, otherwise it is the mean score of the qualities
+    """
+
+    name = "score"
+
+    def __init__(self, min_score, summary=None):
+
+        Stage.__init__(self)
+        self.min_score = min_score
+        self.summary = summary
+        self.scores = summary.columns["mean_qscore_template"] if summary else None
+
+    def keep(self, record):
+
+        buf, base, start, e1, e2, e3, e4 = record
+
+        if self.summary is None:
+            return mean_qscore(buf[e3+1:e4]) >= self.min_score
+
+        row = self.summary.find(read_id(buf, start+1, e1))
+
+        return row >= 0 and self.scores[row] >= self.min_score
+
+    def __getstate__(self):  # the summary is not sent back from workers
+
+        r = dict(self.__dict__)
+        r["summary"] = r["scores"] = None
+
+        return r
+
+
+class StatStage(Stage):
+    """
+    length statistics of the reads passing by
+    """
+
+    def __init__(self, name):
+
+        Stage.__init__(self)
+        self.name = name
+        self.stats = LengthStats()
+
+    def keep(self, record):
+
+        self.stats.add(record[4] - record[3] - 1)
+
+        return True
+
+    def merge(self, other):
+
+        Stage.merge(self, other)
+        self.stats.merge(other.stats)
+
+        return self
+
+
+def build_stages(min_score=None, min_length=0, summary=None):
+    """
+    stages of run: raw stats, clean, length and score filters, filtered stats
+    :param min_score: minimum score, None to not filter by score
+    :param min_length: minimum length
+    :param summary: Summary or None
+    :return: list of Stage
+    """
+    r = [StatStage("raw"), CleanStage()]
+
+    if min_length:
+        r.append(LengthStage(min_length))
+    if min_score is not None:
+        r.append(ScoreStage(min_score, summary))
+
+    r.append(StatStage("filtered"))
+
+    return r
+
+
+def run_stages(records, stages, writer):
+    """
+    pull the records through the stages and write the records left
+    :param records: generator of scan_fastq
+    :param stages: list of Stage
+    :param writer: FastqWriter
+    :return: number of records written
+    """
+    for stage in stages:
+        records = stage(records)
+
+    n = 0
+    for buf, base, start, e1, e2, e3, e4 in records:
+        writer.write_scanned(buf, start, e1, e2, e3, e4)
+        n += 1
+
+    return n
+
+
+def _init_worker(summary, min_score, min_length):
+    _WORKER["summary"] = load_summary(summary) if summary else None
+    _WORKER["min_score"] = min_score
+    _WORKER["min_length"] = min_length
+
+
+def _run_range(job):
+    """
+    run the stages over a byte range, run in a worker process
+    :param job: (file, start, end)
+    :return: (stages, bytes of the records written)
+    """
+    file, start, end = job
+    stages = build_stages(_WORKER["min_score"], _WORKER["min_length"], _WORKER["summary"])
+    fh = io.BytesIO()
+    writer = FastqWriter(fh, close=False)
+
+    run_stages(scan_range(file, start, end), stages, writer)
+    writer.flush()
+
+    return stages, fh.getvalue()
+
+
+def run(args):
+
+    summary = load_summary(args.summary) if args.summary else None
+    stages = build_stages(args.min_score, args.min_length, summary)
+    writer = open_writer(output_name("%s.fastq" % args.out, args.compress), args.compress, threads=args.threads)
+
+    if args.threads > 1 and can_split(args.fastq):
+        # each process runs the stages over byte ranges of the plain fastq
+        for parts, data in map_ranges(_run_range, args.fastq, args.threads, _init_worker,
+                                      (args.summary, args.min_score, args.min_length)):
+            for stage, part in zip(stages, parts):
+                stage.merge(part)
+            writer.write(data)
+    else:
+        fp = open_fastq(args.fastq, threads=args.threads)
+        LOG.info("Parsing seq from %r" % args.fastq)
+        run_stages(scan_fastq(fp), stages, writer)
+        if args.fastq != "-":
+            fp.close()
+
+    writer.close()
+
+    if summary:
+        summary.close()
+
+    with open("%s.stages.tsv" % args.out, "w") as fh:
+        fh.write("#Stage\tReads in\tBases in (bp)\tReads out\tBases out (bp)\n")
+        for stage in stages:
+            LOG.info("stage %s: %s reads in, %s reads out" % (stage.name, stage.reads_in, stage.reads_out))
+            fh.write(stage.row())
+
+    with open("%s.reads_stat.tsv" % args.out, "w") as fh:
+        fh.write(STAT_HEAD)
+        fh.write(stages[0].stats.row("Raw Reads"))
+        fh.write(stages[-1].stats.row("Filtered Reads"))
+
+
+def main():
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format="[%(levelname)s] %(message)s"
+    )
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""
+Clean, filter and stat ont reads in one pass
+
+version: %s
+contact:  %s <%s>\
+    """ % (__version__, " ".join(__author__), __email__))
+
+    parser = add_run_parser(parser)
+    args = parser.parse_args()
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
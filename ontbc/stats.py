@@ -0,0 +1,581 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+run qc of ont sequencing summaries and fastqs
+"""
+import sys
+import math
+import time
+import argparse
+import calendar
+import logging
+from array import array
+from multiprocessing import Pool
+
+from ontbc.parser import add_stats_parser
+from ontbc.fastq import BLOCK_SIZE, open_fastq, scan_fastq
+from ontbc.parallel import split_fastq, split_lines, scan_range
+from ontbc.qscore import mean_qscore
+from ontbc import __author__, __email__, __version__
+
+
+LOG = logging.getLogger(__name__)
+
+# bins of the log length histogram in each power of 10
+LOG_BINS = 10
+# width of the qscore histogram bins
+QSCORE_BIN = 1.0
+# columns of the summary used by stats
+SUMMARY_COLUMNS = ("sequence_length_template", "mean_qscore_template", "channel", "start_time")
+
+STAT_HEAD = "#Type\tBases (bp)\tReads number\tReads mean length (bp)\tReads N50 (bp)\tLongest Reads (bp)\n"
+
+
+class LengthStats(object):
+    """
+    statistics of read lengths updated as reads are read. the number of
+    reads of each length is counted, so N50/N90 are exact without sorting
+    or keeping the lengths of all reads.
+    """
+
+    def __init__(self):
+
+        self.counts = {}  # length -> number of reads
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def add(self, length, n=1):
+        """
+        add n reads of a length
+        """
+        self.counts[length] = self.counts.get(length, 0) + n
+        self.count += n
+        self.sum += length * n
+
+        if length > self.max:
+            self.max = length
+
+    def update(self, lengths, mask=None):
+        """
+        add the reads of a length array, counted with numpy if it is installed
+        :param lengths: array, list or iterable of lengths
+        :param mask: bytearray, 1 for the reads to add, None to add all
+        :return: self
+        """
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+
+        if np is None or not hasattr(lengths, "__len__"):
+            if mask is not None:
+                lengths = (v for v, m in zip(lengths, mask) if m)
+            for v in lengths:
+                self.add(v)
+            return self
+
+        lengths = np.asarray(lengths, dtype=np.int64)
+        if mask is not None:
+            lengths = lengths[np.frombuffer(mask, dtype=np.uint8) == 1]
+        if not len(lengths):
+            return self
+
+        counts = np.bincount(lengths)
+        for v in np.flatnonzero(counts).tolist():
+            self.add(v, int(counts[v]))
+
+        return self
+
+    def merge(self, other):
+        """
+        add the reads of another LengthStats
+        :return: self
+        """
+        for v, n in other.counts.items():
+            self.add(v, n)
+
+        return self
+
+    def mean(self):
+        """
+        mean length, 0 without reads
+        """
+        return self.sum // self.count if self.count else 0
+
+    def nx(self, x=50):
+        """
+        the length L that reads >= L have >= x% of the bases, like N50
+        :param x: percent of bases
+        :return: int, 0 without reads
+        """
+        accu = 0
+
+        for v in sorted(self.counts, reverse=True):
+            accu += v * self.counts[v]
+
+            if accu * 100 >= self.sum * x:
+                return v
+
+        return 0
+
+    def histogram(self, bins=LOG_BINS):
+        """
+        histogram of lengths in log10 bins
+        :param bins: bins in each power of 10
+        :return: list of (lower, upper, reads, bases), empty bins are left out
+        """
+        r = {}
+
+        for v, n in self.counts.items():
+            i = int(math.log10(v) * bins) if v > 0 else -1
+            reads, bases = r.get(i, (0, 0))
+            r[i] = (reads + n, bases + v * n)
+
+        return [(
+            int(math.ceil(10 ** (float(i) / bins))) if i >= 0 else 0,
+            int(math.ceil(10 ** (float(i + 1) / bins))) if i >= 0 else 1,
+            r[i][0], r[i][1]) for i in sorted(r)]
+
+    def distribution(self, window, x_max):
+        """
+        reads and bases of lengths in windows from 0 to x_max, the lengths
+        of each window are summed with numpy if it is installed
+        :param window: width of the windows
+        :param x_max: start of the last window
+        :return: list of (start, reads, bases)
+        """
+        num = x_max // window + 1
+
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+
+        if np is not None and self.counts:
+            lengths = np.fromiter(self.counts.keys(), dtype=np.int64, count=len(self.counts))
+            counts = np.fromiter(self.counts.values(), dtype=np.int64, count=len(self.counts))
+            lengths, counts = lengths[lengths < num * window], counts[lengths < num * window]
+            reads = np.bincount(lengths // window, weights=counts, minlength=num)
+            bases = np.bincount(lengths // window, weights=lengths * counts, minlength=num)
+
+            return [(i * window, int(reads[i]), int(bases[i])) for i in range(num)]
+
+        reads = [0] * num
+        bases = [0] * num
+
+        for v, n in self.counts.items():
+            if v // window < num:
+                reads[v // window] += n
+                bases[v // window] += v * n
+
+        return [(i * window, reads[i], bases[i]) for i in range(num)]
+
+    def row(self, name):
+        """
+        a line of reads_stat.tsv
+        """
+        return "{0}\t{1:,}\t{2:,}\t{3:,}\t{4:,}\t{5:,}\n".format(
+            name, self.sum, self.count, self.mean(), self.nx(50), self.max)
+
+
+def length_stats(lengths, mask=None):
+    """
+    statistics of a length array
+    :param lengths: array of lengths
+    :param mask: bytearray, 1 for the reads to count, None to count all
+    :return: LengthStats
+    """
+    return LengthStats().update(lengths, mask)
+
+
+def _add_counts(counts, keys, lengths):
+    """
+    add the reads and bases of each key to counts
+    :param counts: dict of key -> [reads, bases]
+    :param keys: numpy array of int keys
+    :param lengths: numpy array of lengths
+    """
+    import numpy as np
+
+    uniq, inverse = np.unique(keys, return_inverse=True)
+    reads = np.bincount(inverse)
+    bases = np.bincount(inverse, weights=lengths)
+
+    for key, n, b in zip(uniq.tolist(), reads.tolist(), bases.tolist()):
+        r = counts.setdefault(key, [0, 0])
+        r[0] += n
+        r[1] += int(b)
+
+
+class RunStats(object):
+    """
+    qc of a run: length statistics of all, pass and fail reads, histograms
+    of qscore, reads of each channel and yield over time. statistics of
+    parts of a run are merged with merge.
+    """
+
+    def __init__(self, min_score=7, interval=3600):
+
+        self.min_score = min_score
+        self.interval = interval
+        self.all = LengthStats()
+        self.passed = LengthStats()
+        self.failed = LengthStats()
+        self.qscores = {}  # qscore bin -> [reads, bases]
+        self.channels = {}  # channel -> [reads, bases]
+        self.times = {}  # time bin -> [reads, bases]
+
+    def add(self, length, score, channel=None, start_time=None):
+        """
+        add a read
+        """
+        self.all.add(length)
+
+        if score >= self.min_score:
+            self.passed.add(length)
+        else:
+            self.failed.add(length)
+
+        for counts, key in [(self.qscores, int(math.floor(score / QSCORE_BIN))),
+                            (self.channels, channel),
+                            (self.times, None if start_time is None else int(start_time // self.interval))]:
+            if key is None:
+                continue
+            r = counts.setdefault(key, [0, 0])
+            r[0] += 1
+            r[1] += length
+
+    def update(self, lengths, scores, channels=None, start_times=None):
+        """
+        add the reads of columns, counted with numpy if it is installed
+        :param lengths: array of lengths
+        :param scores: array of qscores
+        :param channels: array of channels or None
+        :param start_times: array of start times in seconds or None
+        :return: self
+        """
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+
+        if np is None:
+            for i in range(len(lengths)):
+                self.add(int(lengths[i]), scores[i],
+                         None if channels is None else int(channels[i]),
+                         None if start_times is None else start_times[i])
+            return self
+
+        lengths = np.asarray(lengths, dtype=np.int64)
+        scores = np.asarray(scores, dtype=np.float64)
+        passed = scores >= self.min_score
+
+        self.all.update(lengths)
+        self.passed.update(lengths[passed])
+        self.failed.update(lengths[~passed])
+        _add_counts(self.qscores, np.floor(scores / QSCORE_BIN).astype(np.int64), lengths)
+
+        if channels is not None:
+            _add_counts(self.channels, np.asarray(channels, dtype=np.int64), lengths)
+        if start_times is not None:
+            _add_counts(self.times, (np.asarray(start_times, dtype=np.float64) // self.interval).astype(np.int64),
+                        lengths)
+
+        return self
+
+    def merge(self, other):
+        """
+        add the reads of another RunStats
+        :return: self
+        """
+        self.all.merge(other.all)
+        self.passed.merge(other.passed)
+        self.failed.merge(other.failed)
+
+        for counts, others in [(self.qscores, other.qscores), (self.channels, other.channels),
+                               (self.times, other.times)]:
+            for key, (n, b) in others.items():
+                r = counts.setdefault(key, [0, 0])
+                r[0] += n
+                r[1] += b
+
+        return self
+
+    def write(self, prefix):
+        """
+        write the qc tables
+        :param prefix: prefix of the tables
+        :return: list of files written
+        """
+        r = []
+
+        with open("%s.reads_stat.tsv" % prefix, "w") as fh:
+            fh.write(STAT_HEAD)
+            fh.write(self.all.row("Raw Reads"))
+            fh.write(self.passed.row("Pass Reads"))
+            fh.write(self.failed.row("Fail Reads"))
+        r.append(fh.name)
+
+        with open("%s.length.tsv" % prefix, "w") as fh:
+            fh.write("#Length from (bp)\tLength to (bp)\tReads number\tBases (bp)\n")
+            for lower, upper, reads, bases in self.all.histogram():
+                fh.write("%s\t%s\t%s\t%s\n" % (lower, upper, reads, bases))
+        r.append(fh.name)
+
+        with open("%s.qscore.tsv" % prefix, "w") as fh:
+            fh.write("#Qscore from\tQscore to\tReads number\tBases (bp)\n")
+            for key in sorted(self.qscores):
+                fh.write("%s\t%s\t%s\t%s\n" % (key * QSCORE_BIN, (key + 1) * QSCORE_BIN,
+                                                  self.qscores[key][0], self.qscores[key][1]))
+        r.append(fh.name)
+
+        if self.channels:
+            with open("%s.channel.tsv" % prefix, "w") as fh:
+                fh.write("#Channel\tReads number\tBases (bp)\n")
+                for key in sorted(self.channels):
+                    fh.write("%s\t%s\t%s\n" % (key, self.channels[key][0], self.channels[key][1]))
+            r.append(fh.name)
+
+        if self.times:
+            first = min(self.times)
+            total = 0
+
+            with open("%s.yield.tsv" % prefix, "w") as fh:
+                fh.write("#Time from (h)\tReads number\tBases (bp)\tTotal bases (bp)\n")
+                for key in range(first, max(self.times) + 1):
+                    reads, bases = self.times.get(key, (0, 0))
+                    total += bases
+                    fh.write("%s\t%s\t%s\t%s\n" % (
+                        round((key - first) * self.interval / 3600.0, 4), reads, bases, total))
+            r.append(fh.name)
+
+        return r
+
+
+def summary_head(file):
+    """
+    find the columns used by stats in the header of a summary
+    :param file: summary file
+    :return: (indexes of SUMMARY_COLUMNS, offset of the line after the header)
+    """
+    offset = 0
+
+    with open(file, "rb") as fh:
+        for line in fh:
+            offset += len(line)
+
+            if not line.strip() or line.startswith(b"#"):
+                continue
+
+            head = line.rstrip(b"\r\n").decode("utf-8").split("\t")
+
+            for i in SUMMARY_COLUMNS:
+                if i not in head:
+                    raise Exception("header of summary has no %s" % i)
+
+            return [head.index(i) for i in SUMMARY_COLUMNS], offset
+
+    raise Exception("summary %r has no header" % file)
+
+
+def _summary_stats(job):
+    """
+    qc of a byte range of a summary, run in a worker process. only the
+    fields up to the last column used are split, without indexing the reads
+    :param job: (file, start, end, indexes, min_score, interval), indexes of
+        SUMMARY_COLUMNS as summary_head
+    :return: RunStats
+    """
+    file, start, end, indexes, min_score, interval = job
+    maxsplit = max(indexes) + 1
+    first = SUMMARY_COLUMNS[0].encode("utf-8")
+    columns = [array("d") for i in indexes]
+
+    fh = open(file, "rb")
+    fh.seek(start)
+    left = end - start
+    rest = b""
+
+    while True:
+        block = fh.read(min(BLOCK_SIZE, left))
+        left -= len(block)
+
+        if block:
+            lines = (rest + block).split(b"\n")
+            rest = lines.pop()
+        elif rest:
+            lines = [rest]
+            rest = b""
+        else:
+            break
+
+        for line in lines:
+            if not line.strip() or line.startswith(b"#"):
+                continue
+
+            fields = line.split(b"\t", maxsplit)
+
+            if fields[indexes[0]] == first:  # header of concatenated summary
+                continue
+
+            for i, column in zip(indexes, columns):
+                column.append(float(fields[i]))
+
+    fh.close()
+
+    return RunStats(min_score, interval).update(*columns)
+
+
+def _header_field(header, key):
+    """
+    value of a key=value field of a fastq header, None if it is missing
+    """
+    start = header.find(b" " + key + b"=")
+
+    if start < 0:
+        return None
+
+    start += len(key) + 2
+    end = header.find(b" ", start)
+
+    return header[start:end if end >= 0 else len(header)].decode("utf-8")
+
+
+def _start_time(value):
+    """
+    seconds of a start_time in a fastq header like 2019-01-01T00:00:00Z
+    """
+    try:
+        return calendar.timegm(time.strptime(value[:19], "%Y-%m-%dT%H:%M:%S"))
+    except ValueError:
+        return None
+
+
+def _fastq_stats(job):
+    """
+    qc of a byte range of a plain fastq or a whole .gz, run in a worker
+    process. the channel and start time are read from the ch= and
+    start_time= fields of the headers written by the basecaller.
+    :param job: (file, start, end, min_score, interval), end is None for a whole file
+    :return: RunStats
+    """
+    file, start, end, min_score, interval = job
+    r = RunStats(min_score, interval)
+
+    if end is None:
+        fp = open_fastq(file)
+        records = scan_fastq(fp)
+    else:
+        fp = None
+        records = scan_range(file, start, end)
+
+    for buf, base, pos, e1, e2, e3, e4 in records:
+        header = buf[pos+1:e1]
+        channel = _header_field(header, b"ch")
+        start_time = _header_field(header, b"start_time")
+
+        r.add(e2 - e1 - 1, mean_qscore(buf[e3+1:e4]),
+              int(channel) if channel and channel.isdigit() else None,
+              _start_time(start_time) if start_time else None)
+
+    if fp is not None:
+        fp.close()
+
+    return r
+
+
+def _map(func, jobs, threads):
+    """
+    map func over jobs with threads processes, the results are not in order
+    """
+    if threads <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            yield func(job)
+        return
+
+    pool = Pool(min(threads, len(jobs)))
+
+    try:
+        for r in pool.imap_unordered(func, jobs):
+            yield r
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def run_stats(func, jobs, threads, min_score=7, interval=3600):
+    """
+    merge the qc of jobs run on threads processes
+    :param func: _summary_stats or _fastq_stats
+    :param jobs: list of the arguments of func
+    :param threads: number of processes
+    :return: RunStats
+    """
+    r = RunStats(min_score, interval)
+
+    for i in _map(func, jobs, threads):
+        r.merge(i)
+
+    return r
+
+
+def stats(args):
+
+    assert args.summary or args.fastq, "--summary or --fastq must be defined"
+    interval = args.interval * 60
+
+    if args.summary:
+        jobs = []
+
+        for i in args.summary:
+            indexes, offset = summary_head(i)
+            jobs += [(i, start, end, indexes, args.min_score, interval)
+                     for start, end in split_lines(i, args.threads, offset)]
+
+        LOG.info("Stat %s summary files in %s parts" % (len(args.summary), len(jobs)))
+        r = run_stats(_summary_stats, jobs, args.threads, args.min_score, interval)
+
+        for i in r.write("%s.summary" % args.out):
+            LOG.info("Write %r" % i)
+
+    if args.fastq:
+        jobs = []
+
+        for i in args.fastq:
+            if i.endswith(".gz"):
+                jobs.append((i, 0, None, args.min_score, interval))
+            else:
+                jobs += [(i, start, end, args.min_score, interval) for start, end in split_fastq(i, args.threads)]
+
+        LOG.info("Stat %s fastq files in %s parts" % (len(args.fastq), len(jobs)))
+        r = run_stats(_fastq_stats, jobs, args.threads, args.min_score, interval)
+
+        for i in r.write("%s.fastq" % args.out):
+            LOG.info("Write %r" % i)
+
+
+def main():
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format="[%(levelname)s] %(message)s"
+    )
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""
+Stat ont runs from summary files and fastq files
+
+version: %s
+contact:  %s <%s>\
+    """ % (__version__, " ".join(__author__), __email__))
+
+    parser = add_stats_parser(parser)
+    args = parser.parse_args()
+    stats(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+column projected loader of ont sequencing summary files
+"""
+import os
+import mmap
+import time
+import errno
+import fcntl
+import os.path
+import logging
+from array import array
+
+from ontbc.common import file_stamp
+from ontbc.table import ReadTable, write_columns, read_columns
+
+
+LOG = logging.getLogger(__name__)
+
+# bytes read from the file at a time
+BLOCK_SIZE = 4 * 1024 * 1024
+# seconds to wait for a cache built by another process
+CACHE_WAIT = 3600
+# seconds between two tries of the lock of a cache
+LOCK_POLL = 5
+
+
+class Summary(object):
+    """
+    sequencing summary with only the needed columns loaded into arrays, the
+    original rows stay in the file and are copied by their offsets
+    """
+
+    def __init__(self, file, columns=("mean_qscore_template",)):
+
+        self.file = file
+        self.head = []
+        self.reads = ReadTable()  # offset and size of the row of each read
+        self.columns = dict((i, array("d")) for i in columns)
+        self._head_line = b""
+        self._mm = None
+
+        self._load()
+
+    def _load(self):
+
+        LOG.info("Parse ont summary from %r" % self.file)
+
+        fh = open(self.file, "rb")
+        rest = b""
+        offset = 0
+        read_index = -1
+        maxsplit = -1
+        indexes = []
+        columns = []
+
+        while True:
+            block = fh.read(BLOCK_SIZE)
+
+            if block:
+                lines = (rest + block).split(b"\n")
+                rest = lines.pop()
+            elif rest:
+                lines = [rest]
+                rest = b""
+            else:
+                break
+
+            for line in lines:
+                size = len(line) + 1
+
+                if not line.strip() or line.startswith(b"#"):
+                    offset += size
+                    continue
+
+                if read_index < 0:  # the header
+                    self._set_head(line)
+                    read_index = self.head.index("read_id")
+                    indexes = [self.head.index(i) for i in self.columns]
+                    columns = [self.columns[i] for i in self.columns]
+                    maxsplit = max([read_index] + indexes) + 1
+                    offset += size
+                    continue
+
+                # only split the fields up to the last column needed
+                fields = line.split(b"\t", maxsplit)
+                read_id = fields[read_index].decode("utf-8")
+
+                if read_id != "read_id":  # header of concatenated summary
+                    self.reads.add(read_id, 0, offset, size)
+                    for i, column in zip(indexes, columns):
+                        column.append(float(fields[i]))
+
+                offset += size
+
+        fh.close()
+
+        if read_index < 0:
+            raise Exception("header of summary has no read_id")
+
+    def _set_head(self, line):
+
+        head = line.rstrip(b"\r").decode("utf-8").split("\t")
+
+        if "read_id" not in head:
+            raise Exception("header of summary has no read_id")
+
+        for i in self.columns:
+            if i not in head:
+                raise Exception("header of summary has no %s" % i)
+
+        self.head = head
+        self._head_line = line + b"\n"
+
+    def __contains__(self, read_id):
+        return self.reads.find(read_id) >= 0
+
+    def find(self, read_id):
+        """
+        row of a read in the summary
+        :return: row, -1 if not found
+        """
+        return self.reads.find(read_id)
+
+    def line(self, row):
+        """
+        original line of a row without "\\n"
+        """
+        if self._mm is None:
+            with open(self.file, "rb") as fh:
+                self._mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        offset = self.reads.offsets[row]
+
+        return self._mm[offset:offset + self.reads.sizes[row]].rstrip(b"\n")
+
+    def fields(self, row):
+        """
+        all fields of a row
+        :return: list of str
+        """
+        return self.line(row).decode("utf-8").split("\t")
+
+    def write_rows(self, rows, out):
+        """
+        write the header and the original lines of rows
+        :param rows: rows in the order to write
+        :param out: binary file object
+        :return: number of rows
+        """
+        out.write(self._head_line)
+        n = 0
+
+        for row in rows:
+            out.write(self.line(row) + b"\n")
+            n += 1
+
+        return n
+
+    def close(self):
+
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    @classmethod
+    def from_cache(cls, file, meta, columns):
+        """
+        summary opened from the arrays of a cache
+        """
+        r = cls.__new__(cls)
+        r.file = file
+        r.head = meta["head"]
+        r.reads = ReadTable.from_columns(columns, meta["names"], prefix="reads.")
+        r.columns = dict((i, columns["column.%s" % i]) for i in meta["columns"])
+        r._head_line = meta["head_line"].encode("utf-8")
+        r._mm = None
+
+        return r
+
+
+def cache_path(file):
+    """
+    path of the binary cache of a summary
+    """
+    return "%s.cache" % file
+
+
+def read_cache(file, columns):
+    """
+    open the binary cache of a summary with mmap
+    :param file: summary file
+    :param columns: columns needed
+    :return: Summary, None if the cache is missing, stale or lacks columns
+    """
+    path = cache_path(file)
+
+    if not os.path.exists(path):
+        return None
+
+    r = read_columns(path)
+    if r is None:
+        return None
+
+    meta, arrays = r
+    if meta.get("stamp") != file_stamp(file) or any(i not in meta["columns"] for i in columns):
+        LOG.info("summary cache %r is stale" % path)
+        return None
+
+    LOG.info("Read ont summary from cache %r" % path)
+
+    return Summary.from_cache(file, meta, arrays)
+
+
+def write_cache(summary):
+    """
+    save the parsed summary to a binary cache next to the summary
+    :param summary: Summary
+    :return: path of the cache, None if it can not be written
+    """
+    path = cache_path(summary.file)
+    meta = {
+        "stamp": file_stamp(summary.file),
+        "head": summary.head,
+        "head_line": summary._head_line.decode("utf-8"),
+        "columns": sorted(summary.columns),
+        "names": summary.reads.names(),
+    }
+    columns = summary.reads.columns(prefix="reads.")
+    for i in meta["columns"]:
+        columns.append(("column.%s" % i, "d", summary.columns[i]))
+
+    try:
+        write_columns(path, meta, columns)
+    except (IOError, OSError):
+        LOG.warning("can not write summary cache %r" % path)
+        return None
+
+    LOG.info("Write ont summary cache to %r" % path)
+
+    return path
+
+
+def load_summary(file, columns=("mean_qscore_template",)):
+    """
+    read a summary from its cache, parse it and write the cache if the cache
+    is missing or stale. only one process builds the cache, the others (the
+    join tasks of barcode start together) wait for it. the lock is a flock
+    of the lock file, released by the kernel if the builder is killed, so
+    the waiters go on at once instead of waiting for CACHE_WAIT. the lock
+    file is removed once the cache is written.
+    :param file: summary file
+    :param columns: columns needed
+    :return: Summary
+    """
+    r = read_cache(file, columns)
+
+    if r is not None:
+        return r
+
+    lock = "%s.lock" % cache_path(file)
+    fh = _open_lock(lock, CACHE_WAIT)
+
+    try:
+        if fh is None:
+            LOG.warning("summary cache %r is not locked, parse it" % cache_path(file))
+
+        # built by the process holding the lock before
+        r = read_cache(file, columns)
+        if r is not None:
+            return r
+
+        r = Summary(file, columns)
+        write_cache(r)
+    finally:
+        if fh is not None:  # the lock file is removed while it is held, closing it releases the lock
+            _remove(lock)
+            fh.close()
+
+    return r
+
+
+def _remove(file):
+    """
+    remove a file, nothing if it is already removed
+    """
+    try:
+        os.remove(file)
+    except (IOError, OSError):
+        pass
+
+
+def _open_lock(lock, timeout):
+    """
+    open and flock a lock file, waiting at most timeout seconds. the holder
+    removes the file before releasing it, so a lock taken on a file which is
+    no more at the path is taken again on the new one
+    :return: file object holding the lock, None if it is not taken
+    """
+    start = time.time()
+
+    while True:
+        try:
+            fh = open(lock, "a")
+        except (IOError, OSError):  # no lock where the cache can not be written
+            return None
+
+        if not _lock(fh, max(timeout - (time.time() - start), 0)):
+            fh.close()
+            return None
+
+        try:
+            if os.path.samestat(os.fstat(fh.fileno()), os.stat(lock)):
+                return fh
+        except (IOError, OSError):  # removed by the holder before
+            pass
+
+        fh.close()
+
+
+def _lock(fh, timeout):
+    """
+    take the exclusive flock of a file, waiting at most timeout seconds
+    :return: True if it is taken
+    """
+    start = time.time()
+
+    while True:
+        try:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                LOG.warning("can not lock %r: %s" % (fh.name, e))
+                return False
+            if time.time() - start >= timeout:
+                return False
+
+        LOG.info("wait for summary cache %r" % fh.name[:-len(".lock")])
+        time.sleep(LOCK_POLL)
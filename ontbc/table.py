@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+compact columnar table of reads
+"""
+import os
+import re
+import sys
+import json
+import mmap
+import struct
+import logging
+from array import array
+from hashlib import md5
+from binascii import hexlify, unhexlify
+
+
+LOG = logging.getLogger(__name__)
+
+_UUID = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+# 64 bit unsigned typecode, "Q" is missing in the array of python 2
+try:
+    array("Q")
+    OFFSET_TYPE = "Q"
+except ValueError:
+    OFFSET_TYPE = "L"
+
+
+def write_columns(file, meta, columns):
+    """
+    write arrays to a binary file which can be opened with mmap, the file is
+    written to a temporary name first so readers never see a partial file
+    :param file: filename
+    :param meta: dict saved as json
+    :param columns: list of (name, typecode, array or bytearray)
+    :return: filename
+    """
+    sections = []
+    offset = 0
+
+    for name, typecode, column in columns:
+        nbytes = len(column) * array(typecode).itemsize
+        sections.append([name, typecode, offset, nbytes])
+        offset += (nbytes + 7) // 8 * 8  # align to 8 bytes
+
+    meta = dict(meta)
+    meta["sections"] = sections
+    meta["byteorder"] = sys.byteorder
+    meta["itemsize"] = dict((i[1], array(i[1]).itemsize) for i in columns)
+    meta = json.dumps(meta).encode("utf-8")
+    start = (16 + len(meta) + 7) // 8 * 8
+
+    temp = "%s.%s.tmp" % (file, os.getpid())
+    with open(temp, "wb") as fh:
+        fh.write(b"ONTBCCOL")
+        fh.write(struct.pack("<Q", len(meta)))
+        fh.write(meta)
+        fh.write(b"\0" * (start - 16 - len(meta)))
+
+        for (name, typecode, column), section in zip(columns, sections):
+            fh.write(column)
+            fh.write(b"\0" * ((section[3] + 7) // 8 * 8 - section[3]))
+
+    os.rename(temp, file)
+
+    return file
+
+
+def _itemsize(typecode):
+    """
+    itemsize of an array typecode, None if it is not supported
+    """
+    try:
+        return array(str(typecode)).itemsize
+    except ValueError:
+        return None
+
+
+def read_columns(file):
+    """
+    open a file written by write_columns with mmap, the arrays are
+    memoryviews of the file under python 3 and copies under python 2
+    :param file: filename
+    :return: (meta, dict of name -> array), None if the file is not valid
+    """
+    with open(file, "rb") as fh:
+        if fh.read(8) != b"ONTBCCOL":
+            return None
+        size = struct.unpack("<Q", fh.read(8))[0]
+        meta = json.loads(fh.read(size).decode("utf-8"))
+
+        if meta["byteorder"] != sys.byteorder or \
+                any(_itemsize(k) != v for k, v in meta["itemsize"].items()):
+            return None
+
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    start = (16 + size + 7) // 8 * 8
+    r = {}
+
+    for name, typecode, offset, nbytes in meta["sections"]:
+        offset += start
+
+        if hasattr(memoryview, "cast"):
+            r[name] = memoryview(mm)[offset:offset+nbytes].cast(str(typecode))
+        elif typecode == "B":
+            r[name] = bytearray(mm[offset:offset+nbytes])
+        else:
+            r[name] = array(str(typecode), mm[offset:offset+nbytes])
+
+    return meta, r
+
+
+def pack_id(read_id):
+    """
+    pack a read id to 16 bytes, an uuid is packed as it is,
+    other ids are packed with their md5
+    :param read_id: str
+    :return: (bytes, is_uuid)
+    """
+    if _UUID.match(read_id):
+        return unhexlify(read_id.replace("-", "")), True
+
+    return md5(read_id.encode("utf-8")).digest(), False
+
+
+def unpack_id(key):
+    """
+    the uuid of 16 bytes packed by pack_id
+    """
+    h = hexlify(key).decode("ascii")
+
+    return "%s-%s-%s-%s-%s" % (h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+
+def _hash(key):
+    """
+    hash of a packed id, the same in every process so the index can be saved
+    """
+    return struct.unpack_from("<Q", key)[0]
+
+
+class ReadTable(object):
+    """
+    reads stored by columns: packed ids (16 bytes each), lengths, offsets and
+    sizes in arrays, with an open addressing hash index from id to row.
+    a table opened by from_columns is read only.
+    """
+
+    def __init__(self):
+
+        self.ids = bytearray()
+        self.lengths = array("I")
+        self.offsets = array(OFFSET_TYPE)
+        self.sizes = array("I")
+        self._names = {}  # row -> id, only for ids which are not uuid
+        self._slots = array("i", [0]) * 8  # row + 1, 0 is empty
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __contains__(self, read_id):
+        return self.find(read_id) >= 0
+
+    def _insert(self, key, row):
+
+        slots = self._slots
+        mask = len(slots) - 1
+        i = _hash(key) & mask
+
+        while slots[i]:
+            i = (i + 1) & mask
+
+        slots[i] = row + 1
+
+    def _resize(self, size=0):
+
+        self._slots = array("i", [0]) * (size or len(self._slots) * 2)
+        ids = bytes(self.ids)
+
+        for row in range(len(self)):
+            self._insert(ids[row*16:row*16+16], row)
+
+    def add(self, read_id, length, offset=0, size=0):
+        """
+        add a read to the end of the table
+        :return: row of the read
+        """
+        key, is_uuid = pack_id(read_id)
+        row = len(self.lengths)
+
+        self.ids += key
+        self.lengths.append(length)
+        self.offsets.append(offset)
+        self.sizes.append(size)
+
+        if not is_uuid:
+            self._names[row] = read_id
+
+        if (row + 1) * 2 > len(self._slots):
+            self._resize()
+        else:
+            self._insert(key, row)
+
+        return row
+
+    @classmethod
+    def concat(cls, tables):
+        """
+        join tables in order, the index is built once at the end
+        :param tables: iterable of ReadTable
+        :return: ReadTable
+        """
+        r = cls()
+
+        for table in tables:
+            n = len(r)
+            r.ids += table.ids
+            r.lengths.extend(table.lengths)
+            r.offsets.extend(table.offsets)
+            r.sizes.extend(table.sizes)
+            r._names.update((row + n, v) for row, v in table._names.items())
+
+        size = 8
+        while size < len(r) * 2:
+            size *= 2
+        r._resize(size)
+
+        return r
+
+    def find(self, read_id):
+        """
+        row of a read, the first one if the id is duplicated
+        :return: row, -1 if not found
+        """
+        key = pack_id(read_id)[0]
+        slots = self._slots
+        ids = self.ids
+        mask = len(slots) - 1
+        i = _hash(key) & mask
+
+        while slots[i]:
+            row = slots[i] - 1
+            if ids[row*16:row*16+16] == key:
+                return row
+            i = (i + 1) & mask
+
+        return -1
+
+    def read_id(self, row):
+        """
+        read id of a row
+        """
+        if row in self._names:
+            return self._names[row]
+
+        return unpack_id(bytes(self.ids[row*16:row*16+16]))
+
+    def columns(self, prefix=""):
+        """
+        columns to save with write_columns
+        :return: list of (name, typecode, array)
+        """
+        return [
+            (prefix + "ids", "B", self.ids),
+            (prefix + "lengths", "I", self.lengths),
+            (prefix + "offsets", OFFSET_TYPE, self.offsets),
+            (prefix + "sizes", "I", self.sizes),
+            (prefix + "slots", "i", self._slots),
+        ]
+
+    def names(self):
+        """
+        ids which are not uuid, row -> id
+        """
+        return dict(self._names)
+
+    @classmethod
+    def from_columns(cls, columns, names, prefix=""):
+        """
+        read only table of the columns read by read_columns
+        :param columns: dict of name -> array
+        :param names: ids which are not uuid, row -> id
+        :param prefix: prefix of the column names
+        :return: ReadTable
+        """
+        r = cls()
+        r.ids = columns[prefix + "ids"]
+        r.lengths = columns[prefix + "lengths"]
+        r.offsets = columns[prefix + "offsets"]
+        r.sizes = columns[prefix + "sizes"]
+        r._slots = columns[prefix + "slots"]
+        r._names = dict((int(k), v) for k, v in names.items())
+
+        return r
+
+    def nbytes(self):
+        """
+        bytes used by the columns and the hash index
+        """
+        return len(self.ids) + sum(i.itemsize * len(i) for i in
+                                   [self.lengths, self.offsets, self.sizes, self._slots])
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+buffered writers of fastq records
+"""
+import os
+import sys
+import logging
+
+from ontbc.bgzf import BgzfWriter
+
+
+LOG = logging.getLogger(__name__)
+
+# bytes collected before a write to the file
+WRITE_SIZE = 1024 * 1024
+
+
+def _stdout():
+    """
+    binary stdout
+    """
+    sys.stdout.flush()
+
+    return sys.stdout.buffer if sys.version[0] == "3" else sys.stdout
+
+
+class FastqWriter(object):
+    """
+    collect records into a buffer and write it to the file in bulk. raw
+    records are passed as spans of the buffer they were read in, spans next
+    to each other are copied once, and ranges of plain files are copied by
+    the kernel with os.sendfile when the output is a plain file too.
+    """
+
+    def __init__(self, fh, size=WRITE_SIZE, close=True):
+
+        self.fh = fh
+        self.size = size
+        self._close = close
+        self._buf = []
+        self._nbytes = 0
+        self._span = [None, 0, 0]  # buf, start, end of the span not copied yet
+        self._sendfile = hasattr(os, "sendfile") and hasattr(fh, "fileno")
+
+    def write(self, data):
+        """
+        write bytes, usually the raw bytes of records
+        """
+        self._end_span()
+        self._buf.append(data)
+        self._nbytes += len(data)
+
+        if self._nbytes >= self.size:
+            self._write_buffer()
+
+    def write_span(self, buf, start, end):
+        """
+        write buf[start:end], the raw bytes of a record in the block it was read in
+        """
+        span = self._span
+
+        if buf is span[0] and start == span[2]:
+            span[2] = end
+        else:
+            self._end_span()
+            self._span = [buf, start, end]
+
+    def _end_span(self):
+
+        buf, start, end = self._span
+
+        if buf is not None:
+            self._span = [None, 0, 0]
+            self.write(buf[start:end])
+
+    def copy_range(self, fp, offset, size):
+        """
+        copy size bytes at offset of a binary file
+        :param fp: binary file object which can seek
+        :param offset: offset in fp
+        :param size: bytes to copy
+        :return: the last byte copied, b"" if nothing is copied
+        """
+        end = offset + size
+
+        if self._sendfile and hasattr(fp, "fileno"):
+            try:
+                in_fd = fp.fileno()
+                self.flush()
+                start = offset
+
+                while offset < end:
+                    n = os.sendfile(self.fh.fileno(), in_fd, offset, end - offset)
+                    if not n:
+                        break
+                    offset += n
+
+                return os.pread(in_fd, 1, offset - 1) if offset > start else b""
+            except (OSError, ValueError):  # not files which sendfile supports
+                self._sendfile = False
+
+        fp.seek(offset)
+        last = b""
+
+        while offset < end:
+            data = fp.read(min(self.size, end - offset))
+            if not data:
+                break
+            offset += len(data)
+            self.write(data)
+            last = data[-1:]
+
+        return last
+
+    def write_record(self, name, seq, qual):
+        """
+        write a record of bytes with a bare "+" line
+        """
+        self.write(b"@" + name + b"\n" + seq + b"\n+\n" + qual + b"\n")
+
+    def write_scanned(self, buf, start, e1, e2, e3, e4):
+        """
+        write a record of scan_fastq with a bare "+" line, a record which
+        has one already is written as the bytes read
+        """
+        if e3 == e2 + 2:
+            self.write_span(buf, start, e4 + 1)
+        else:
+            self.write_record(buf[start+1:e1], buf[e1+1:e2], buf[e3+1:e4])
+
+    def _write_buffer(self):
+
+        if self._buf:
+            self.fh.write(b"".join(self._buf))
+            self._buf = []
+            self._nbytes = 0
+
+    def flush(self):
+
+        self._end_span()
+        self._write_buffer()
+        self.fh.flush()
+
+    def close(self):
+
+        self._end_span()
+        self._write_buffer()
+
+        if self._close:
+            self.fh.close()
+        else:
+            self.fh.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_writer(file=None, compress=False, threads=1, size=WRITE_SIZE):
+    """
+    open a buffered writer of fastq, compressed outputs are bgzf which
+    is gzip compatible, with a .gzi index when written to a file
+    :param file: filename, None or "-" for stdout
+    :param compress: compress the output, files ending with .gz are always compressed
+    :param threads: threads to compress
+    :param size: bytes collected before a write
+    :return: FastqWriter
+    """
+    if file in (None, "-"):
+        if compress:  # closing the BgzfWriter does not close stdout
+            return FastqWriter(BgzfWriter(None, threads=threads, fh=_stdout()), size=size)
+        return FastqWriter(_stdout(), size=size, close=False)
+
+    if compress or file.endswith(".gz"):
+        fh = BgzfWriter(file, threads=threads)
+    else:
+        fh = open(file, "wb")
+
+    return FastqWriter(fh, size=size)
+
+
+def output_name(file, compress=False):
+    """
+    name of an output, with .gz if it is compressed
+    """
+    if compress and not file.endswith(".gz"):
+        return "%s.gz" % file
+
+    return file